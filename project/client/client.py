@@ -4,7 +4,10 @@ import itertools
 import json
 import sys
 import logging
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 from hdrh import histogram
 import requests
@@ -19,7 +22,30 @@ def get_stat_string(hist):
     return "Latency Perecentiles(ms) - 50th:%4.2f, 95th:%4.2f, 99th:%4.2f, 100th:%4.2f - Count:%s" % (d[50], d[95], d[99], d[100], hist.get_total_count())
 
 
-def load_file(jsonfile, endpoint, halt_on_error, id_attr=None, ids_to_keep=[], limit=None):
+def record_response(r, x, latency, counts, hist, responses_to_keep, id_attr, ids_to_keep):
+    """
+    Tally a response into counts, record its latency (ms) and keep its body if
+    requested. Returns False if the response was an error.
+    """
+    if r.status_code >= 400:
+        logging.error("Error.  %s  Body: %s" % (r, r.content))
+        return False
+    if r.status_code == 200 or r.status_code == 201:
+        counts[r.status_code] += 1
+        hist.record_value(latency)
+        logging.debug("Resp: %s  Body: %s" % (r,r.content))
+    else:
+        counts['other'] += 1
+        logging.info("Resp: %s  Body: %s" % (r, r.content))
+    # Check if we should save response
+    if id_attr and x[id_attr] in ids_to_keep:
+        responses_to_keep[x[id_attr]] = r.json()
+    return True
+
+
+def load_file(jsonfile, endpoint, halt_on_error, id_attr=None, ids_to_keep=[], limit=None, concurrency=1, rate=None):
+    if rate or concurrency > 1:
+        return load_file_concurrent(jsonfile, endpoint, halt_on_error, id_attr, ids_to_keep, limit, concurrency, rate)
     with open(jsonfile) as f:
         json_input = json.load(f)
         counts = {200: 0,
@@ -29,28 +55,19 @@ def load_file(jsonfile, endpoint, halt_on_error, id_attr=None, ids_to_keep=[], l
         responses_to_keep = {}
         hist = histogram.HdrHistogram(1, 1000 * 60 * 60, 2)
         count = 0
+        session = requests.Session()
+        run_start = timer()
         for x in json_input:
             counts['total'] += 1
             try:
                 start = timer()
-                r = requests.post(endpoint, json=x)
+                r = session.post(endpoint, json=x)
                 end = timer()
-                if r.status_code >= 400:
-                    logging.error("Error.  %s  Body: %s" % (r, r.content))
+                if not record_response(r, x, (end - start) * 1000, counts, hist,
+                                       responses_to_keep, id_attr, ids_to_keep):
                     if halt_on_error:
                         logging.error("Halting. Input that caused the issue: %s" %x)
                         sys.exit(1)
-                else:
-                    if r.status_code == 200 or r.status_code == 201:
-                        counts[r.status_code] += 1
-                        hist.record_value((end - start) * 1000)
-                        logging.debug("Resp: %s  Body: %s" % (r,r.content))
-                    else:
-                        counts['other'] += 1
-                        logging.info("Resp: %s  Body: %s" % (r, r.content))
-                    # Check if we should save response
-                    if id_attr and x[id_attr] in ids_to_keep:
-                        responses_to_keep[x[id_attr]] = r.json()
             except ConnectionError as err:
                 logging.error("Connection error, halting %s" % err)
                 if halt_on_error:
@@ -68,8 +85,87 @@ def load_file(jsonfile, endpoint, halt_on_error, id_attr=None, ids_to_keep=[], l
             if limit and count >= limit:
                 logging.info("Breaking early due to limit %s " % limit)
                 break
+        counts['elapsed'] = timer() - run_start
     return counts, hist, responses_to_keep
 
+
+def load_file_concurrent(jsonfile, endpoint, halt_on_error, id_attr, ids_to_keep, limit, concurrency, rate=None):
+    """
+    Same as load_file, but keeps concurrency requests in flight at once from a
+    pool of worker threads, each posting over its own keep-alive session.
+
+    With a rate (requests/s) the run is open loop instead: request i is due at
+    start + i/rate whatever happened to earlier requests, and its latency is
+    measured from that intended send time. Time spent waiting for a free
+    worker behind a slow server is therefore counted, rather than omitted.
+    """
+    with open(jsonfile) as f:
+        json_input = json.load(f)
+    if limit:
+        json_input = json_input[:limit]
+
+    counts = {200: 0,
+              201: 0,
+              'other': 0,
+              'total': 0}
+    responses_to_keep = {}
+    hist = histogram.HdrHistogram(1, 1000 * 60 * 60, 2)
+    lock = threading.Lock()
+    halt = threading.Event()
+    local = threading.local()
+
+    def send(x, due=None):
+        if halt.is_set():
+            return
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            start = timer() if due is None else due
+            r = local.session.post(endpoint, json=x)
+            end = timer()
+            with lock:
+                counts['total'] += 1
+                ok = record_response(r, x, (end - start) * 1000, counts, hist,
+                                     responses_to_keep, id_attr, ids_to_keep)
+            if not ok and halt_on_error:
+                logging.error("Halting. Input that caused the issue: %s" %x)
+                halt.set()
+        except ConnectionError as err:
+            logging.error("Connection error, halting %s" % err)
+            halt.set()
+        except:
+            logging.error("Unexpected error: %s" % sys.exc_info()[0])
+            traceback.print_exc()
+            if halt_on_error:
+                logging.error("Halting. Input that caused the issue: %s" %x)
+                halt.set()
+
+    run_start = timer()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if not rate:
+            list(executor.map(send, json_input))
+        else:
+            for i, x in enumerate(json_input):
+                if halt.is_set():
+                    break
+                due = run_start + i / rate
+                wait = due - timer()
+                if wait > 0:
+                    time.sleep(wait)
+                executor.submit(send, x, due)
+    counts['elapsed'] = timer() - run_start
+
+    if halt.is_set() and halt_on_error:
+        sys.exit(1)
+    return counts, hist, responses_to_keep
+
+
+def get_throughput_string(counts):
+    elapsed = counts.get('elapsed', 0)
+    rate = counts['total'] / elapsed if elapsed else 0
+    return "Throughput: %.2f req/s (%s requests in %.2fs)" % (rate, counts['total'], elapsed)
+
+
 def build_idx(server, port):
     idx_url = 'http://{}:{}/buildidx'.format(server, port) #TODO
     start = timer()
@@ -78,7 +174,7 @@ def build_idx(server, port):
     return r.status_code, idx_time
 
 # MAIN FLOW
-def run_loader(server, port, insp_file, tweet_file, index_timing, load_type, halt_on_error=False, limit=None, clean=False):
+def run_loader(server, port, insp_file, tweet_file, index_timing, load_type, halt_on_error=False, limit=None, clean=False, concurrency=1, rate=None):
     logging.info("Calling loader")
     # Reset db
     reset_url = 'http://{}:{}/reset'.format(server, port)
@@ -113,11 +209,12 @@ def run_loader(server, port, insp_file, tweet_file, index_timing, load_type, hal
             sys.exit(1)
         # Load inspections
         insp_endpoint = "http://{}:{}/inspections".format(server, port)
-        insp_counts, insp_hist, insp_responses = load_file(insp_file, insp_endpoint, halt_on_error, "inspection_id", ["2370195","1"], limit)
+        insp_counts, insp_hist, insp_responses = load_file(insp_file, insp_endpoint, halt_on_error, "inspection_id", ["2370195","1"], limit, concurrency, rate)
         insp_time = insp_hist.get_mean_value() * insp_hist.get_total_count()
         logging.info(insp_responses)
         logging.info('Inspection total load time: {}'.format(insp_time))
         logging.info(get_stat_string(insp_hist))
+        logging.info(get_throughput_string(insp_counts))
         logging.info("Total: %s Count of 200:%s Count of 201:%s Count of other <400:%s" %(insp_counts['total'], insp_counts[200], insp_counts[201], insp_counts['other']))
 
     # Index post-insert
@@ -135,10 +232,11 @@ def run_loader(server, port, insp_file, tweet_file, index_timing, load_type, hal
             logging.info('Fatal error: could not set transaction size before loading tweets')
             sys.exit(1)
         tweet_endpoint = "http://{}:{}/tweet".format(server, port)
-        tweet_counts, tweet_hist, tweet_responses = load_file(tweet_file, tweet_endpoint, halt_on_error)
+        tweet_counts, tweet_hist, tweet_responses = load_file(tweet_file, tweet_endpoint, halt_on_error, concurrency=concurrency, rate=rate)
         tweet_time = insp_hist.get_mean_value() * insp_hist.get_total_count()
         logging.info('Tweet load time: {}'.format(tweet_time))
         logging.info(get_stat_string(tweet_hist))
+        logging.info(get_throughput_string(tweet_counts))
         logging.info("Total: %s Count of 200:%s Count of 201:%s Count of other <400:%s" %(tweet_counts['total'], tweet_counts[200], tweet_counts[201], tweet_counts['other']))
     else:
         logging.info("Skipping Tweets")
@@ -177,6 +275,8 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", help="Show detailed log messages", action="store_true")
     parser.add_argument("-l", "--limit", help="Limit records for non-bulk loader", default=None, type=int)
     parser.add_argument("--clean", help="Invoke the cleaning script after loading records and tweets", action="store_true")
+    parser.add_argument("-c", "--concurrency", help="Number of requests kept in flight for non-bulk loading (default 1)", default=1, type=int)
+    parser.add_argument("-r", "--rate", help="Open loop: send non-bulk requests at this many per second and measure latency from each intended send time", default=None, type=float)
 
 
     config = parser.parse_args()
@@ -196,5 +296,5 @@ if __name__ == "__main__":
         sys.exit(1)
 
     run_loader(config.server, config.port, config.insp_file, config.tweet_file,
-               config.index_timing, config.load_type, config.halt, config.limit, config.clean)
+               config.index_timing, config.load_type, config.halt, config.limit, config.clean, config.concurrency, config.rate)
     
\ No newline at end of file
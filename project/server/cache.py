@@ -0,0 +1,75 @@
+'''
+Provides a bounded, thread-safe LRU cache with a time-to-live for the read
+endpoints in server.py.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    Holds at most maxsize entries, evicting the least recently used. Entries
+    older than ttl seconds are treated as misses. Hits and misses are counted
+    for /cache/stats.
+    '''
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        '''
+        Returns (True, value) if key is cached and fresh, else (False, None).
+        '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+
+        return False, None
+
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl
+            }
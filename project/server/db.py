@@ -1,7 +1,194 @@
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2 import DatabaseError, sql
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+import io
+import itertools
 import logging
 import match_records
+import math
+import multiprocessing
+import queue
+import streams
+import uuid
+from tweet_index import EARTH_RADIUS, METERS_PER_DEGREE
+
+
+def csv_copy_chunk(rows, out, size):
+    """
+    Write up to size rows from a csv reader to out as csv. Returns the number
+    of rows written.
+    """
+
+    writer = csv.writer(out, lineterminator='\n')
+    n = 0
+    for row in itertools.islice(rows, size):
+        writer.writerow(row)
+        n += 1
+
+    return n
+
+
+def format_restaurant(r):
+    """
+    Convert an ri_restaurants row into the restaurant dictionary returned by
+    the server.
+    """
+
+    lon, lat = r['location'].strip('()').split(',') if r['location'] else (None, None)
+    return {
+        "id" : r['id'],
+        "name": r['name'],
+        "facility_type": r['facility_type'],
+        "address": r['address'],
+        "city": r['city'],
+        "state": r['state'],
+        "zip": r['zip'],
+        "latitude": lat,
+        "longitude": lon,
+        "clean": r['clean']
+        }
+
+
+def format_inspection(i):
+    """
+    Convert an ri_inspections row into the inspection dictionary returned by
+    the server. A missing date is null, as in find_restaurant_with_inspections.
+    """
+
+    return {
+        "id": i['id'],
+        "risk": i['risk'],
+        "date": str(i['inspection_date']) if i['inspection_date'] is not None else None,
+        "inspection_type": i['inspection_type'],
+        "results": i['results'],
+        "violations": i['violations'],
+        "restaurant_id": i['restaurant_id']
+        }
+
+
+# Folds the rows of an "inserted" relation of ri_inspections rows (usually a
+# data-modifying CTE) into ri_restaurant_summary. Prefix with
+# "WITH inserted AS (...)". Risk rank 1 is the highest; unknown risks rank 4.
+SUMMARY_UPSERT = """
+    INSERT INTO ri_restaurant_summary AS s (restaurant_id, inspection_count,
+        latest_inspection_id, latest_inspection_date, latest_result,
+        pass_count, fail_count, highest_risk, highest_risk_rank, violation_count)
+    SELECT restaurant_id,
+        count(*),
+        (array_agg(id ORDER BY inspection_date DESC NULLS LAST, id DESC))[1],
+        max(inspection_date),
+        (array_agg(results ORDER BY inspection_date DESC NULLS LAST, id DESC))[1],
+        count(*) FILTER (WHERE results IN ('Pass', 'Pass w/ Conditions')),
+        count(*) FILTER (WHERE results = 'Fail'),
+        (array_agg(risk ORDER BY COALESCE(substring(risk from 'Risk ([0-9])')::smallint, 4), id))[1],
+        min(COALESCE(substring(risk from 'Risk ([0-9])')::smallint, 4)),
+        sum(COALESCE(array_length(string_to_array(NULLIF(violations, ''), ' | '), 1), 0))
+    FROM inserted
+    GROUP BY restaurant_id
+    ON CONFLICT (restaurant_id) DO UPDATE SET
+        inspection_count = s.inspection_count + EXCLUDED.inspection_count,
+        latest_inspection_id = CASE WHEN s.latest_inspection_id IS NULL OR
+            (COALESCE(EXCLUDED.latest_inspection_date, '-infinity'), EXCLUDED.latest_inspection_id) >
+            (COALESCE(s.latest_inspection_date, '-infinity'), s.latest_inspection_id)
+            THEN EXCLUDED.latest_inspection_id ELSE s.latest_inspection_id END,
+        latest_result = CASE WHEN s.latest_inspection_id IS NULL OR
+            (COALESCE(EXCLUDED.latest_inspection_date, '-infinity'), EXCLUDED.latest_inspection_id) >
+            (COALESCE(s.latest_inspection_date, '-infinity'), s.latest_inspection_id)
+            THEN EXCLUDED.latest_result ELSE s.latest_result END,
+        latest_inspection_date = GREATEST(s.latest_inspection_date, EXCLUDED.latest_inspection_date),
+        pass_count = s.pass_count + EXCLUDED.pass_count,
+        fail_count = s.fail_count + EXCLUDED.fail_count,
+        highest_risk = CASE WHEN EXCLUDED.highest_risk_rank < s.highest_risk_rank
+            THEN EXCLUDED.highest_risk ELSE s.highest_risk END,
+        highest_risk_rank = LEAST(s.highest_risk_rank, EXCLUDED.highest_risk_rank),
+        violation_count = s.violation_count + EXCLUDED.violation_count
+    """
+
+
+def format_summary(s):
+    """
+    Convert an ri_restaurant_summary row into the summary dictionary returned
+    by the server. A restaurant without inspections has no row, so s may be
+    None.
+    """
+
+    s = s or {}
+    return {
+        "inspection_count": s.get('inspection_count') or 0,
+        "latest_inspection_id": s.get('latest_inspection_id'),
+        "latest_inspection_date": str(s['latest_inspection_date']) if s.get('latest_inspection_date') else None,
+        "latest_result": s.get('latest_result'),
+        "pass_count": s.get('pass_count') or 0,
+        "fail_count": s.get('fail_count') or 0,
+        "highest_risk": s.get('highest_risk'),
+        "violation_count": s.get('violation_count') or 0
+        }
+
+
+def tweet_box(lon, lat, radius):
+    """
+    The bounding box, as box text, around the circle of radius meters
+    searched for restaurants near a tweet's location, or None if the tweet
+    has no location. Points in the box are then filtered by haversine
+    distance, as the in-process RestaurantIndex of tweet_index does.
+    """
+
+    if lon and lat:
+        dlat = radius / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        return str(((lon - dlon, lat - dlat), (lon + dlon, lat + dlat)))
+
+    return None
+
+
+def search_conditions(filters, joined=True):
+    """
+    Build the WHERE conditions and parameters for the search endpoints from
+    a dictionary of filters. r is ri_restaurants and i is ri_inspections;
+    unless joined, the inspection filters are checked against the inspections
+    of r in an EXISTS subquery.
+    """
+
+    conditions = []
+    params = []
+
+    if filters.get('name'):
+        # prefix match, escaping LIKE wildcards in the prefix itself
+        prefix = filters['name'].upper()
+        for c in ('\\', '%', '_'):
+            prefix = prefix.replace(c, '\\' + c)
+        conditions.append("UPPER(r.name) LIKE %s")
+        params.append(prefix + '%')
+
+    for column in ('zip', 'state', 'facility_type'):
+        if filters.get(column):
+            conditions.append("r.{} = %s".format(column))
+            params.append(filters[column])
+
+    inspection_conditions = []
+    for column in ('risk', 'results'):
+        if filters.get(column):
+            inspection_conditions.append("i.{} = %s".format(column))
+            params.append(filters[column])
+
+    if filters.get('start'):
+        inspection_conditions.append("i.inspection_date >= %s")
+        params.append(filters['start'])
+    if filters.get('end'):
+        inspection_conditions.append("i.inspection_date <= %s")
+        params.append(filters['end'])
+
+    if joined:
+        conditions.extend(inspection_conditions)
+    elif inspection_conditions:
+        conditions.append("""EXISTS (
+                SELECT 1 FROM ri_inspections i
+                WHERE i.restaurant_id = r.id AND {})""".format(
+            " AND ".join(inspection_conditions)))
+
+    return conditions, params
+
 
 """
 Wraps a single connection to the database with higher-level functionality.
@@ -9,18 +196,29 @@ Wraps a single connection to the database with higher-level functionality.
 class DB:
     def __init__(self, connection):
         self.conn = connection
+        # set once the whole transaction, with any batched loads, is undone
+        self.rolled_back = False
 
 
-    def bad_request(self, e, cur, rollback=True, status=400):
+    def bad_request(self, e, cur, rollback=True, status=400, savepoint=None):
         """
         Helper function to handle bad request: rollback, close cursor,
-        return correct status.
+        return correct status. With a savepoint only the statements since
+        it are rolled back, keeping earlier loads in the transaction.
         """
 
         logging.error("DB error: %s", e)
         logging.error("Query attempted: %s", cur.query)
-        if rollback:
+        if rollback and savepoint:
+            try:
+                cur.execute(sql.SQL("ROLLBACK TO SAVEPOINT {};").format(
+                    sql.Identifier(savepoint)))
+            except (Exception, DatabaseError) as e:
+                logging.error("DB error: %s", e)
+                savepoint = None
+        if rollback and not savepoint:
             self.conn.rollback()
+            self.rolled_back = True
         cur.close()
 
         return status
@@ -47,7 +245,7 @@ class DB:
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
 
         TRUNCATE_TABLES = """
-            TRUNCATE ri_restaurants, ri_inspections, ri_tweetmatch CASCADE;
+            TRUNCATE ri_restaurants, ri_inspections, ri_restaurant_summary, ri_tweetmatch, ri_bulk_checkpoints CASCADE;
             """
 
         DROP_IDX_NAME = """
@@ -58,11 +256,14 @@ class DB:
             DROP INDEX IF EXISTS ri_restaurants_location_idx;
             """
 
-        DROP_IDX_NAME_ADDRESS = """
-            DROP INDEX IF EXISTS ri_restaurants_name_address_idx;
+        DROP_IDX_SEARCH = """
+            DROP INDEX IF EXISTS ri_restaurants_name_prefix_idx,
+                ri_restaurants_zip_idx,
+                ri_inspections_date_idx,
+                ri_inspections_results_date_idx;
             """
 
-        commands = [TRUNCATE_TABLES, DROP_IDX_NAME, DROP_IDX_LOCATION, DROP_IDX_NAME_ADDRESS]
+        commands = [TRUNCATE_TABLES, DROP_IDX_NAME, DROP_IDX_LOCATION, DROP_IDX_SEARCH]
 
         for command in commands:
             try:
@@ -151,162 +352,627 @@ class DB:
             cur.close()
             return status, inspection
         else:
-            inspection = {
-                "id": i['id'],
-                "risk": i['risk'],
-                "date": str(i['inspection_date']),
-                "inspection_type": i['inspection_type'],
-                "results": i['results'],
-                "violations": i['violations'],
-                "restaurant_id": i['restaurant_id']
-                }
+            inspection = format_inspection(i)
             status = self.ok_request(cur, commit=False, status=200)
 
         return status, inspection
 
 
-    def find_inspections(self, restaurant_id):
+    def find_restaurant_with_inspections(self, restaurant_id, limit=None, after=None):
         """
-        Searches for all inspections associated with the given restaurant.
-        Returns an empty list if no matching inspections are found.
+        Fetches a restaurant and its inspections, newest first, in one query.
+        At most limit inspections are returned, starting after the inspection
+        with id after. Returns None for the restaurant if it cannot be found.
         """
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        restaurant = None
         inspections = []
 
+        RESTAURANT_INSPECTIONS = """
+            SELECT r.id, r.name, r.facility_type, r.address, r.city, r.state, r.zip,
+                r.location, r.clean,
+                COALESCE(i.inspections, '[]'::json) AS inspections
+            FROM ri_restaurants r
+            LEFT JOIN LATERAL (
+                SELECT json_agg(json_build_object(
+                        'id', p.id,
+                        'risk', p.risk,
+                        'date', p.inspection_date::text,
+                        'inspection_type', p.inspection_type,
+                        'results', p.results,
+                        'violations', p.violations,
+                        'restaurant_id', p.restaurant_id)
+                    ORDER BY p.sort_date DESC, p.id DESC) AS inspections
+                FROM (
+                    SELECT *, COALESCE(inspection_date, '-infinity') AS sort_date
+                    FROM ri_inspections
+                    WHERE restaurant_id = r.id
+                    AND (%(after)s IS NULL
+                         OR (COALESCE(inspection_date, '-infinity'), id) <
+                            (SELECT COALESCE(inspection_date, '-infinity'), id
+                             FROM ri_inspections
+                             WHERE id = %(after)s))
+                    ORDER BY sort_date DESC, id DESC
+                    LIMIT %(limit)s
+                ) p
+            ) i ON true
+            WHERE r.id = %(id)s;
+            """
+
+        try:
+            cur.execute(RESTAURANT_INSPECTIONS,
+                {'id': restaurant_id, 'limit': limit, 'after': after})
+            r = cur.fetchone()
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, restaurant, inspections
+
+        if not r:
+            status = 404
+            cur.close()
+            return status, restaurant, inspections
+
+        restaurant = format_restaurant(r)
+        inspections = r['inspections']
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status, restaurant, inspections
+
+
+    def find_restaurants(self, restaurant_ids):
+        """
+        Fetches many restaurants and their inspections with one query per
+        table. Returns a dictionary of restaurant id to
+        {'restaurant': ..., 'inspections': [...]}; ids that cannot be found
+        are left out.
+        """
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        restaurants = {}
+
+        RESTAURANTS_SEARCH = """
+            SELECT *
+            FROM ri_restaurants
+            WHERE id = ANY(%s);
+            """
+
         INSPECTIONS_SEARCH = """
             SELECT *
             FROM ri_inspections
-            WHERE restaurant_id = %s;
+            WHERE restaurant_id = ANY(%s)
+            ORDER BY inspection_date DESC NULLS LAST, id DESC;
             """
 
-        # get a list of inspection tuples
         try:
-            cur.execute(INSPECTIONS_SEARCH,
-                (restaurant_id, ))
-            i = cur.fetchall()
+            cur.execute(RESTAURANTS_SEARCH, (list(restaurant_ids),))
+            for r in cur.fetchall():
+                restaurants[r['id']] = {'restaurant': format_restaurant(r),
+                                        'inspections': []}
+
+            cur.execute(INSPECTIONS_SEARCH, (list(restaurants),))
+            for i in cur.fetchall():
+                restaurants[i['restaurant_id']]['inspections'].append(
+                    format_inspection(i))
         except (Exception, DatabaseError) as e:
             status = self.bad_request(e, cur, rollback=False, status=400)
-            return status, inspections
+            return status, restaurants
 
-        if i:
-            for item in i:
-                inspection = self.find_inspection(item['id'])[1]
-                inspections.append(inspection)
-        
         status = self.ok_request(cur, commit=False, status=200)
 
-        return status, inspections
+        return status, restaurants
+
+
+    def find_restaurants_by_inspections(self, inspection_ids):
+        """
+        Finds the restaurant of each of many inspections with one query per
+        table. Returns a dictionary of inspection id to restaurant; ids that
+        cannot be found are left out.
+        """
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        found = {}
+
+        INSPECTIONS_SEARCH = """
+            SELECT id, restaurant_id
+            FROM ri_inspections
+            WHERE id = ANY(%s);
+            """
+
+        RESTAURANTS_SEARCH = """
+            SELECT *
+            FROM ri_restaurants
+            WHERE id = ANY(%s);
+            """
+
+        try:
+            cur.execute(INSPECTIONS_SEARCH, ([str(i) for i in inspection_ids],))
+            inspections = cur.fetchall()
+
+            cur.execute(RESTAURANTS_SEARCH,
+                (list(set(i['restaurant_id'] for i in inspections)),))
+            restaurants = dict((r['id'], format_restaurant(r)) for r in cur.fetchall())
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, found
+
+        for i in inspections:
+            if i['restaurant_id'] in restaurants:
+                found[i['id']] = restaurants[i['restaurant_id']]
+
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status, found
+
+
+    def find_summaries(self, restaurant_ids):
+        """
+        Reads the precomputed inspection summary of each of many restaurants
+        from ri_restaurant_summary, without touching ri_inspections. Returns a
+        dictionary of restaurant id to {'restaurant': ..., 'summary': ...};
+        ids that cannot be found are left out.
+        """
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        summaries = {}
+
+        SUMMARY_SEARCH = """
+            SELECT r.*, to_jsonb(s) AS summary
+            FROM ri_restaurants r
+            LEFT JOIN ri_restaurant_summary s
+            ON s.restaurant_id = r.id
+            WHERE r.id = ANY(%s);
+            """
+
+        try:
+            cur.execute(SUMMARY_SEARCH, (list(restaurant_ids),))
+            for r in cur.fetchall():
+                summaries[r['id']] = {'restaurant': format_restaurant(r),
+                                      'summary': format_summary(r['summary'])}
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, summaries
+
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status, summaries
+
+
+    def export_table(self, table, fmt, zip=None, start=None, end=None, clean=None, itersize=5000):
+        """
+        Generator that streams restaurants, inspections, tweetmatch or linked
+        rows as csv or ndjson text, itersize rows at a time, through a
+        server-side cursor so memory use does not grow with the table. Rows
+        can be filtered on the restaurant's zip and clean flag, and
+        inspections on their date.
+        """
+
+        EXPORT_QUERIES = {
+            'restaurants': """
+                SELECT r.id, r.name, r.facility_type, r.address, r.city, r.state,
+                    r.zip, r.location, r.clean
+                FROM ri_restaurants r
+                """,
+            'inspections': """
+                SELECT i.id, i.risk, i.inspection_date, i.inspection_type,
+                    i.results, i.violations, i.restaurant_id
+                FROM ri_inspections i
+                JOIN ri_restaurants r ON r.id = i.restaurant_id
+                """,
+            'tweetmatch': """
+                SELECT t.tkey, t.restaurant_id, t.match
+                FROM ri_tweetmatch t
+                JOIN ri_restaurants r ON r.id = t.restaurant_id
+                """,
+            'linked': """
+                SELECT l.primary_rest_id, l.original_rest_id
+                FROM ri_linked l
+                JOIN ri_restaurants r ON r.id = l.primary_rest_id
+                """
+        }
+
+        conditions = []
+        params = []
+        if zip:
+            conditions.append("r.zip = %s")
+            params.append(zip)
+        if clean is not None:
+            conditions.append("r.clean = %s")
+            params.append(clean)
+        if table == 'inspections' and start:
+            conditions.append("i.inspection_date >= %s")
+            params.append(start)
+        if table == 'inspections' and end:
+            conditions.append("i.inspection_date <= %s")
+            params.append(end)
+
+        query = EXPORT_QUERIES[table]
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if fmt == 'ndjson':
+            query = "SELECT row_to_json(x)::text FROM (" + query + ") x"
+
+        cur = self.conn.cursor(name='export_' + uuid.uuid4().hex)
+        cur.itersize = itersize
+
+        try:
+            cur.execute(query, params)
+            out = io.StringIO()
+            writer = csv.writer(out, lineterminator='\n')
+            header = fmt == 'csv'
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                if header:
+                    writer.writerow([c[0] for c in cur.description])
+                    header = False
+                if fmt == 'csv':
+                    writer.writerows(rows)
+                else:
+                    for row in rows:
+                        out.write(row[0])
+                        out.write('\n')
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+        except (Exception, DatabaseError) as e:
+            # the response has already started, all we can do is stop
+            logging.error("DB error during export: %s", e)
+        finally:
+            cur.close()
+
+
+    def search_restaurants(self, filters, limit, after=None):
+        """
+        Search restaurants by name prefix, zip, state and facility type, and
+        by having an inspection with the given risk, results and date range,
+        ordered by id. Pages are fetched by keyset: after is the last id of
+        the previous page. Returns the restaurants and the id to continue
+        after, or None on the last page.
+        """
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        restaurants = []
+        next_after = None
+
+        conditions, params = search_conditions(filters, joined=False)
+        if after is not None:
+            conditions.append("r.id > %s")
+            params.append(after)
+
+        RESTAURANT_SEARCH = """
+            SELECT *
+            FROM ri_restaurants r
+            {}
+            ORDER BY r.id
+            LIMIT %s;
+            """.format("WHERE " + " AND ".join(conditions) if conditions else "")
+
+        try:
+            cur.execute(RESTAURANT_SEARCH, params + [limit])
+            rows = cur.fetchall()
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, restaurants, next_after
+
+        restaurants = [format_restaurant(r) for r in rows]
+        if len(rows) == limit:
+            next_after = rows[-1]['id']
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status, restaurants, next_after
+
+
+    def search_inspections(self, filters, limit, after=None):
+        """
+        Search inspections by their risk, results and date range and by their
+        restaurant's name prefix, zip, state and facility type, newest first.
+        Pages are fetched by keyset: after is the (date, id) of the last
+        inspection of the previous page. Inspections without a date are not
+        searchable. Returns the matches and the key to continue after, or
+        None on the last page.
+        """
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        matches = []
+        next_after = None
+
+        conditions, params = search_conditions(filters)
+        conditions.append("i.inspection_date IS NOT NULL")
+        if after is not None:
+            conditions.append("(i.inspection_date, i.id) < (%s, %s)")
+            params.extend(after)
+
+        INSPECTION_SEARCH = """
+            SELECT i.id, i.risk, i.inspection_date, i.inspection_type,
+                i.results, i.violations, i.restaurant_id,
+                r.name, r.facility_type, r.address, r.city, r.state, r.zip,
+                r.location, r.clean
+            FROM ri_inspections i
+            JOIN ri_restaurants r ON r.id = i.restaurant_id
+            WHERE {}
+            ORDER BY i.inspection_date DESC, i.id DESC
+            LIMIT %s;
+            """.format(" AND ".join(conditions))
+
+        try:
+            cur.execute(INSPECTION_SEARCH, params + [limit])
+            rows = cur.fetchall()
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, matches, next_after
+
+        for row in rows:
+            matches.append({
+                'inspection': format_inspection(row),
+                'restaurant': format_restaurant(dict(row, id=row['restaurant_id']))
+                })
+        if len(rows) == limit:
+            next_after = (str(rows[-1]['inspection_date']), rows[-1]['id'])
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status, matches, next_after
 
 
     def add_inspection_for_restaurant(self, inspection, restaurant):
         """
         Finds or creates the restaurant then inserts the inspection and
-        associates it with the restaurant.
+        associates it with the restaurant. Relies on the unique constraint on
+        ri_restaurants(name, address), so a new inspection costs at most two
+        statements. A failed load only undoes its own statements, not the
+        loads batched before it in the transaction.
         """
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
         restaurant_id = None
 
-        RESTAURANT_SEARCH = """
-            SELECT id 
+        # the restaurant is only created if the inspection is new; the
+        # second half of the union sees the pre-insert snapshot so exactly
+        # one row comes back whether or not the restaurant already existed
+        RESTAURANT_UPSERT = """
+            WITH ins AS (
+                INSERT INTO ri_restaurants (name, facility_type, address, city, state, zip, location, clean)
+                SELECT %s, %s, %s, %s, %s, %s, point(%s), %s
+                WHERE NOT EXISTS (SELECT 1 FROM ri_inspections WHERE id = %s)
+                ON CONFLICT (name, address) DO NOTHING
+                RETURNING id
+            )
+            SELECT id, true AS created FROM ins
+            UNION ALL
+            SELECT id, false AS created
             FROM ri_restaurants
             WHERE name = %s
             AND address = %s;
             """
 
-        RESTAURANT_INSERT = """
-            INSERT INTO ri_restaurants (name, facility_type, address, city, state, zip, location, clean)
-            VALUES (%s, %s, %s, %s, %s, %s, point(%s), %s);
+        RESTAURANT_SEARCH = """
+            SELECT id, false AS created
+            FROM ri_restaurants
+            WHERE name = %s
+            AND address = %s;
             """
 
-        INSPECTION_SEARCH = """
-            SELECT id 
+        INSPECTION_OWNER = """
+            SELECT restaurant_id AS id, false AS created
             FROM ri_inspections
             WHERE id = %s;
             """
 
+        # the summary only sees the inspection if it was actually inserted
         INSPECTION_INSERT = """
-            INSERT INTO ri_inspections (id, risk, inspection_date, inspection_type, results, violations, restaurant_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """
+            WITH inserted AS (
+                INSERT INTO ri_inspections (id, risk, inspection_date, inspection_type, results, violations, restaurant_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (id) DO NOTHING
+                RETURNING *
+            )
+            """ + SUMMARY_UPSERT
 
         try:
-            cur.execute(RESTAURANT_SEARCH,
-                (restaurant['name'], 
+            cur.execute("SAVEPOINT inspection_load;")
+            cur.execute(RESTAURANT_UPSERT,
+                (restaurant['name'],
+                 restaurant['facility_type'],
+                 restaurant['address'],
+                 restaurant['city'],
+                 restaurant['state'],
+                 restaurant['zip'],
+                 restaurant['location'] if restaurant['location'] else None,
+                 restaurant['clean'],
+                 inspection['id'],
+                 restaurant['name'],
                  restaurant['address']))
             r = cur.fetchone()
+
+            # a concurrent insert committed after our snapshot was taken
+            if not r:
+                cur.execute(RESTAURANT_SEARCH,
+                    (restaurant['name'],
+                     restaurant['address']))
+                r = cur.fetchone()
+
+            # the inspection is already loaded under another restaurant;
+            # nothing was written, so it is reported like any known one
+            if not r:
+                cur.execute(INSPECTION_OWNER, (inspection['id'],))
+                r = cur.fetchone()
         except (Exception, DatabaseError) as e:
-            status = self.bad_request(e, cur, rollback=False, status=400)
+            status = self.bad_request(e, cur, rollback=True, status=400,
+                                      savepoint='inspection_load')
+            return status, restaurant_id
+
+        if not r:
+            cur.execute("RELEASE SAVEPOINT inspection_load;")
+            status = 400
+            cur.close()
             return status, restaurant_id
 
         try:
-            cur.execute(INSPECTION_SEARCH,
-                (inspection['id'],))
-            i = cur.fetchone()
+            cur.execute(INSPECTION_INSERT,
+                (inspection['id'],
+                 inspection['risk'],
+                 inspection['inspection_date'],
+                 inspection['inspection_type'],
+                 inspection['results'],
+                 inspection['violations'],
+                 r['id']))
+            cur.execute("RELEASE SAVEPOINT inspection_load;")
         except (Exception, DatabaseError) as e:
-            status = self.bad_request(e, cur, rollback=False, status=400)
+            status = self.bad_request(e, cur, rollback=True, status=400,
+                                      savepoint='inspection_load')
             return status, restaurant_id
 
-        if not r and not i: 
-            try:
-                cur.execute(RESTAURANT_INSERT,
-                    (restaurant['name'],
-                     restaurant['facility_type'],
-                     restaurant['address'],
-                     restaurant['city'],
-                     restaurant['state'],
-                     restaurant['zip'],
-                     restaurant['location'] if restaurant['location'] else None,
-                     restaurant['clean']))
-            except (Exception, DatabaseError) as e:
-                status = self.bad_request(e, cur, rollback=True, status=400)
-                return status, restaurant_id
+        restaurant_id = r['id']
+        status = self.ok_request(cur, commit=False,
+                                 status=201 if r['created'] else 200)
 
-            try:
-                cur.execute(RESTAURANT_SEARCH,
-                    (restaurant['name'], 
-                     restaurant['address']))
-                r = cur.fetchone()
-            except (Exception, DatabaseError) as e:
-                status = self.bad_request(e, cur, rollback=False, status=400)
-                return status, restaurant_id
+        return status, restaurant_id
 
-            try:
-                cur.execute(INSPECTION_INSERT,
-                    (inspection['id'],
-                     inspection['risk'],
-                     inspection['inspection_date'],
-                     inspection['inspection_type'],
-                     inspection['results'],
-                     inspection['violations'],
-                     r['id']))
-            except (Exception, DatabaseError) as e:
-                status = self.bad_request(e, cur, rollback=True, status=400)
-                return status, restaurant_id
 
-            status = self.ok_request(cur, commit=False, status=201)
-            restaurant_id = r['id']
+    def add_inspections_for_restaurants(self, records):
+        """
+        Batched version of add_inspection_for_restaurant. Takes a list of
+        (inspection, restaurant) pairs, stages them in a temp table and
+        finds or creates the restaurants and inserts the inspections with
+        set-based statements, falling back to one record at a time if they
+        fail. Returns a list of (status, restaurant_id) in the same order as
+        records.
+        """
 
-        else:
-            if not i:
-                try:
-                    cur.execute(INSPECTION_INSERT,
-                        (inspection['id'],
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        results = []
+
+        if not records:
+            status = self.ok_request(cur, commit=False, status=200)
+            return status, results
+
+        CREATE_TEMP = """
+            DROP TABLE IF EXISTS batch_temp;
+            CREATE TEMP TABLE batch_temp (
+                idx int,
+                inspection_id varchar(16),
+                risk varchar(50),
+                inspection_date date,
+                inspection_type varchar(50),
+                results varchar(50),
+                violations text,
+                name varchar(100) NOT NULL,
+                facility_type varchar(50),
+                address varchar(60),
+                city varchar(30),
+                state char(2),
+                zip char(5),
+                location point,
+                clean boolean
+                );
+            """
+
+        STAGE_INSERT = """
+            INSERT INTO batch_temp VALUES %s;
+            """
+
+        STAGE_TEMPLATE = """
+            (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, point(%s), %s)
+            """
+
+        # only create restaurants for records whose inspection is new,
+        # matching the single record behaviour
+        RESTAURANT_INSERT = """
+            INSERT INTO ri_restaurants (name, facility_type, address, city, state, zip, location, clean)
+            SELECT DISTINCT ON (b.name, b.address)
+                b.name, b.facility_type, b.address, b.city, b.state, b.zip, b.location, b.clean
+            FROM batch_temp b
+            WHERE NOT EXISTS (SELECT 1 FROM ri_inspections i
+                              WHERE i.id = b.inspection_id)
+            ORDER BY b.name, b.address, b.idx
+            ON CONFLICT (name, address) DO NOTHING
+            RETURNING id;
+            """
+
+        INSPECTION_INSERT = """
+            WITH inserted AS (
+                INSERT INTO ri_inspections (id, risk, inspection_date, inspection_type, results, violations, restaurant_id)
+                SELECT DISTINCT ON (b.inspection_id)
+                    b.inspection_id, b.risk, b.inspection_date, b.inspection_type, b.results, b.violations, r.id
+                FROM batch_temp b
+                JOIN ri_restaurants r
+                ON r.name = b.name AND r.address = b.address
+                ORDER BY b.inspection_id, b.idx, r.id
+                ON CONFLICT (id) DO NOTHING
+                RETURNING *
+            )
+            """ + SUMMARY_UPSERT
+
+        # as for a single record, an inspection already loaded under another
+        # restaurant resolves to that restaurant
+        RESTAURANT_RESOLVE = """
+            SELECT b.idx, COALESCE(
+                (SELECT r.id FROM ri_restaurants r
+                 WHERE r.name = b.name AND r.address = b.address
+                 ORDER BY r.id LIMIT 1),
+                (SELECT i.restaurant_id FROM ri_inspections i
+                 WHERE i.id = b.inspection_id)) AS id
+            FROM batch_temp b;
+            """
+
+        rows = []
+        for idx, (inspection, restaurant) in enumerate(records):
+            rows.append((idx,
+                         inspection['id'],
                          inspection['risk'],
                          inspection['inspection_date'],
                          inspection['inspection_type'],
                          inspection['results'],
                          inspection['violations'],
-                         r['id']))
-                except (Exception, DatabaseError) as e:
-                    status = self.bad_request(e, cur, rollback=True, status=400)
-                    return status, restaurant_id
+                         restaurant['name'],
+                         restaurant['facility_type'],
+                         restaurant['address'],
+                         restaurant['city'],
+                         restaurant['state'],
+                         restaurant['zip'],
+                         restaurant['location'] if restaurant['location'] else None,
+                         restaurant['clean']))
+
+        # a record the statements reject (a bad date, an overlong name)
+        # fails them all, so the batch is then undone and loaded record by
+        # record, leaving the transaction's earlier loads alone
+        try:
+            cur.execute("SAVEPOINT batch_load;")
+            cur.execute(CREATE_TEMP)
+            execute_values(cur, STAGE_INSERT, rows,
+                           template=STAGE_TEMPLATE, page_size=len(rows))
+            cur.execute(RESTAURANT_INSERT)
+            created = set(r['id'] for r in cur.fetchall())
+            cur.execute(INSPECTION_INSERT)
+            cur.execute(RESTAURANT_RESOLVE)
+            resolved = dict((r['idx'], r['id']) for r in cur.fetchall())
+            cur.execute("RELEASE SAVEPOINT batch_load;")
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=True, status=400,
+                                      savepoint='batch_load')
+            if self.rolled_back:
+                return status, results
+            for inspection, restaurant in records:
+                results.append(self.add_inspection_for_restaurant(inspection, restaurant))
+                if self.rolled_back:
+                    return 400, []
+            return 200, results
+
+        # the first record for a new restaurant gets a 201, like a single POST
+        for idx in range(len(records)):
+            restaurant_id = resolved.get(idx)
+            if restaurant_id is None:
+                results.append((400, None))
+            elif restaurant_id in created:
+                created.discard(restaurant_id)
+                results.append((201, restaurant_id))
+            else:
+                results.append((200, restaurant_id))
 
-            status = self.ok_request(cur, commit=False, status=200)
-            restaurant_id = r['id']
+        status = self.ok_request(cur, commit=False, status=200)
 
-        return status, restaurant_id
+        return status, results
 
 
     def count_all_insp(self):
@@ -335,16 +1001,16 @@ class DB:
         return status, record
 
 
-    def bulk_loading(self, data):
+    def create_bulk_temp(self, cur, table='bulk_temp', temp=True):
         '''
-        SELECT and INSERT entries from a bulk file.
+        Create (or recreate) a bulk staging table. By default this is the
+        session's bulk_temp table; with temp=False it is an unlogged table
+        that other connections can COPY into.
         '''
 
-        cur = self.conn.cursor(cursor_factory = RealDictCursor)
-
         CREATE_TEMP = """
-            DROP TABLE IF EXISTS bulk_temp;
-            CREATE TEMP TABLE bulk_temp (
+            DROP TABLE IF EXISTS {table};
+            CREATE {kind} TABLE {table} (
                 inspection_id varchar(16),
                 name varchar(60) NOT NULL,
                 aka_name varchar(60),
@@ -365,8 +1031,67 @@ class DB:
                 );
             """
 
+        cur.execute(sql.SQL(CREATE_TEMP).format(
+            table=sql.Identifier(table),
+            kind=sql.SQL('TEMP' if temp else 'UNLOGGED')))
+
+
+    def merge_bulk_temp(self, cur, table='bulk_temp'):
+        '''
+        Move the staged rows in a bulk staging table into ri_restaurants and
+        ri_inspections. Returns the number of inspections inserted.
+        '''
+
+        # fresh statistics let the planner probe the (name, address)
+        # constraint per staged row instead of scanning ri_restaurants
+        ANALYZE_TEMP = """
+            ANALYZE {};
+            """
+
+        # dedupe within the batch and against existing restaurants using the
+        # permanent unique constraint, so the cost follows the batch size
+        RESTAURANT_INSERT = """
+            INSERT INTO ri_restaurants (name, facility_type, address, city, state, zip, location)
+            SELECT DISTINCT ON (b.name, b.address)
+                b.name, b.facility_type, b.address, b.city, b.state, b.zip, b.location
+            FROM {} b
+            WHERE NOT EXISTS (SELECT 1 FROM ri_restaurants r
+                              WHERE r.name = b.name AND r.address = b.address)
+            ORDER BY b.name, b.address
+            ON CONFLICT (name, address) DO NOTHING;
+            """
+
+        INSPECTION_INSERT = """
+            WITH inserted AS (
+                INSERT INTO ri_inspections (id, risk, inspection_date, inspection_type, results, violations, restaurant_id)
+                SELECT b.inspection_id, b.risk, b.date, b.inspection_type, b.results, b.violations, r.id
+                FROM {} b
+                JOIN ri_restaurants r
+                ON r.name = b.name AND r.address = b.address
+                ON CONFLICT (id) DO NOTHING
+                RETURNING *
+            ), summary AS (
+            """ + SUMMARY_UPSERT + """
+                RETURNING 1
+            )
+            SELECT count(*) AS inserted FROM inserted;
+            """
+
+        for command in [ANALYZE_TEMP, RESTAURANT_INSERT, INSPECTION_INSERT]:
+            cur.execute(sql.SQL(command).format(sql.Identifier(table)))
+
+        return cur.fetchone()['inserted']
+
+
+    def bulk_loading(self, data):
+        '''
+        SELECT and INSERT entries from a bulk file.
+        '''
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+
         try: 
-            cur.execute(CREATE_TEMP)
+            self.create_bulk_temp(cur)
         except (Exception, DatabaseError) as e:
             return self.bad_request(e, cur, rollback=True, status=400)
 
@@ -375,43 +1100,297 @@ class DB:
         except (Exception, DatabaseError) as e:
             return self.bad_request(e, cur, rollback=True, status=400)
 
-        RESTAURANT_INSERT = """
-            CREATE UNIQUE INDEX IF NOT EXISTS ri_restaurants_name_address_idx
-            ON ri_restaurants(name, address);
-            INSERT INTO ri_restaurants (name, facility_type, address, city, state, zip, location)
-            SELECT name, facility_type, address, city, state, zip, location
-            FROM bulk_temp
-            ON CONFLICT (name, address) DO NOTHING;
-            DROP INDEX IF EXISTS ri_restaurants_name_address_idx;
+        try:
+            self.merge_bulk_temp(cur)
+        except (Exception, DatabaseError) as e:
+            return self.bad_request(e, cur, rollback=True, status=400)
+
+        status = self.ok_request(cur, commit=True, status=200)
+
+        return status
+
+
+    def bulk_loading_chunked(self, data, load_id, chunk_size, progress):
+        '''
+        Load a bulk csv chunk_size rows at a time, committing each chunk along
+        with a checkpoint in ri_bulk_checkpoints. Running the same load_id
+        again skips the rows already committed, so an interrupted load resumes
+        from its last chunk. The progress dict is updated after every chunk.
+        '''
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+
+        CHECKPOINT_START = """
+            INSERT INTO ri_bulk_checkpoints (load_id)
+            VALUES (%s)
+            ON CONFLICT (load_id) DO UPDATE SET updated = now()
+            RETURNING rows_committed, rows_inserted, finished;
             """
 
-        INSPECTION_INSERT = """
-            INSERT INTO ri_inspections (id, risk, inspection_date, inspection_type, results, violations, restaurant_id)
-            SELECT b.inspection_id, b.risk, b.date, b.inspection_type, b.results, b.violations, r.id
-            FROM bulk_temp b
-            JOIN ri_restaurants r
-            ON r.name = b.name AND r.address = b.address
-            ON CONFLICT (id) DO NOTHING;
+        CHECKPOINT_UPDATE = """
+            UPDATE ri_bulk_checkpoints
+            SET rows_committed = rows_committed + %s,
+                rows_inserted = rows_inserted + %s,
+                finished = %s,
+                updated = now()
+            WHERE load_id = %s;
             """
 
         try:
-            cur.execute(RESTAURANT_INSERT)
+            cur.execute(CHECKPOINT_START, (load_id,))
+            checkpoint = cur.fetchone()
+            self.create_bulk_temp(cur)
+            self.conn.commit()
         except (Exception, DatabaseError) as e:
             return self.bad_request(e, cur, rollback=True, status=400)
 
+        skip = checkpoint['rows_committed']
+        progress['rows_skipped'] = skip
+        progress['rows_copied'] = skip
+        progress['rows_inserted'] = checkpoint['rows_inserted']
+        if checkpoint['finished']:
+            progress['state'] = 'finished'
+            return self.ok_request(cur, commit=False, status=200)
+
+        rows = csv.reader(streams.text_lines(data))
+        next(rows, None)
+        # rows already committed by an earlier run of this load
+        for _ in itertools.islice(rows, skip):
+            pass
+
+        while True:
+            chunk = io.StringIO()
+            n = csv_copy_chunk(rows, chunk, chunk_size)
+            chunk.seek(0)
+
+            try:
+                inserted = 0
+                if n:
+                    cur.execute("TRUNCATE bulk_temp;")
+                    cur.copy_expert("COPY bulk_temp FROM STDIN CSV QUOTE '\"';", chunk)
+                    inserted = self.merge_bulk_temp(cur)
+                cur.execute(CHECKPOINT_UPDATE, (n, inserted, n < chunk_size, load_id))
+                self.conn.commit()
+            except (Exception, DatabaseError) as e:
+                progress['state'] = 'failed'
+                return self.bad_request(e, cur, rollback=True, status=400)
+
+            progress['rows_copied'] += n
+            progress['rows_inserted'] += inserted
+            if n < chunk_size:
+                break
+
+        progress['state'] = 'finished'
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status
+
+
+    def parallel_bulk_loading(self, pool, data, workers, chunk_size):
+        '''
+        Bulk load a csv by splitting it into chunk_size row pieces and COPYing
+        them concurrently over workers dedicated connections into an unlogged
+        staging table, then merging the staged rows into ri_restaurants and
+        ri_inspections with the same set-based statements as bulk_loading.
+        The COPY connections are opened for the load rather than taken from
+        the pool, so they never hold another client's batched loads and the
+        load cannot wait on the pool.
+        '''
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        stage = 'bulk_stage_' + uuid.uuid4().hex
+        stage_copy = sql.SQL("COPY {} FROM STDIN CSV QUOTE '\"';").format(
+            sql.Identifier(stage)).as_string(self.conn)
+
+        DROP_STAGE = sql.SQL("""
+            DROP TABLE IF EXISTS {};
+            """).format(sql.Identifier(stage))
+
         try:
-            cur.execute(INSPECTION_INSERT)
+            self.create_bulk_temp(cur, stage, temp=False)
+            self.conn.commit()
         except (Exception, DatabaseError) as e:
             return self.bad_request(e, cur, rollback=True, status=400)
 
+        # one connection per worker, handed between pieces
+        connections = queue.Queue()
+
+        def copy_piece(piece):
+            conn = connections.get()
+            try:
+                with conn.cursor() as piece_cur:
+                    piece_cur.copy_expert(stage_copy, piece)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                connections.put(conn)
+
+        rows = csv.reader(streams.text_lines(data))
+        next(rows, None)
+
+        try:
+            for _ in range(workers):
+                connections.put(pool.connect())
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                running = []
+                try:
+                    while True:
+                        piece = io.StringIO()
+                        if not csv_copy_chunk(rows, piece, chunk_size):
+                            break
+                        piece.seek(0)
+                        running.append(executor.submit(copy_piece, piece))
+                        # keep at most two pieces per worker in memory
+                        if len(running) >= 2 * workers:
+                            running.pop(0).result()
+                    for f in running:
+                        f.result()
+                except Exception:
+                    for f in running:
+                        f.cancel()
+                    raise
+
+            self.merge_bulk_temp(cur, stage)
+            cur.execute(DROP_STAGE)
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=True, status=400)
+            self.drop_stage(DROP_STAGE)
+            return status
+        finally:
+            while not connections.empty():
+                connections.get().close()
+
         status = self.ok_request(cur, commit=True, status=200)
 
         return status
 
 
-    def match_tweet(self, tweet):
+    def drop_stage(self, drop):
+        '''
+        Helper function for parallel_bulk_loading to remove its staging table
+        after a failed load.
+        '''
+
+        cur = self.conn.cursor()
+        try:
+            cur.execute(drop)
+        except (Exception, DatabaseError) as e:
+            self.bad_request(e, cur, rollback=True, status=500)
+            return
+
+        self.ok_request(cur, commit=True)
+
+
+    def get_bulk_checkpoint(self, load_id):
+        '''
+        Look up the committed progress of a chunked bulk load.
+        '''
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        checkpoint = None
+
+        CHECKPOINT_SEARCH = """
+            SELECT load_id, rows_committed, rows_inserted, finished, updated
+            FROM ri_bulk_checkpoints
+            WHERE load_id = %s;
+            """
+
+        try:
+            cur.execute(CHECKPOINT_SEARCH, (load_id,))
+            checkpoint = cur.fetchone()
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, checkpoint
+
+        if not checkpoint:
+            status = 404
+            cur.close()
+            return status, checkpoint
+
+        checkpoint['updated'] = str(checkpoint['updated'])
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status, checkpoint
+
+
+    def find_restaurant_keys(self, after=0):
+        '''
+        Returns the id, upper-cased name and location of every restaurant
+        with an id above after, for the in-process tweet indexes.
+        '''
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        keys = []
+
+        KEYS_SEARCH = """
+            SELECT id, UPPER(name) AS name, location
+            FROM ri_restaurants
+            WHERE id > %s;
+            """
+
+        try:
+            cur.execute(KEYS_SEARCH, (after,))
+            keys = cur.fetchall()
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, keys
+
+        status = self.ok_request(cur, commit=False, status=200)
+
+        return status, keys
+
+
+    def insert_tweet_matches(self, matches):
         '''
-        Receives a tweet and see if it matches a restaurant by name or location
+        Record (tkey, restaurant_id, match) rows found by the in-process
+        tweet indexes in ri_tweetmatch with one statement. Restaurants the
+        indexes still hold but that no longer exist are skipped. Returns a
+        dictionary of tkey to the ids of the matched restaurants.
+        '''
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        matched = {}
+
+        if not matches:
+            status = self.ok_request(cur, commit=False, status=200)
+            return status, matched
+
+        TWEETMATCH_INSERT = """
+            WITH found AS (
+                SELECT v.tkey, r.id, v.match::match_type AS match
+                FROM (VALUES %s) AS v (tkey, restaurant_id, match)
+                JOIN ri_restaurants r
+                ON r.id = v.restaurant_id
+            ), inserted AS (
+                INSERT INTO ri_tweetmatch (tkey, restaurant_id, match)
+                SELECT tkey, id, match FROM found
+                ON CONFLICT (tkey, restaurant_id) DO NOTHING
+            )
+            SELECT DISTINCT tkey, id
+            FROM found
+            ORDER BY tkey, id;
+            """
+
+        try:
+            r = execute_values(cur, TWEETMATCH_INSERT, matches,
+                               page_size=len(matches), fetch=True)
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=True, status=400)
+            return status, matched
+
+        status = self.ok_request(cur, commit=True, status=200)
+        for item in r:
+            matched.setdefault(item['tkey'], []).append(item['id'])
+
+        return status, matched
+
+
+    def match_tweet(self, tweet, radius):
+        '''
+        Receives a tweet and see if it matches a restaurant by name or by
+        location within radius meters
         '''
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
@@ -426,72 +1405,152 @@ class DB:
             status = self.bad_request(e, cur, rollback=False, status=400)
 
         # create a bounding box to search for nearby points using the index
-        if tlong and tlat:
-            box = str(((tlong - 0.00302190, tlat - 0.00225001),
-                (tlong + 0.00302190, tlat + 0.00225001)))
-        else:
-            box = None
+        box = tweet_box(tlong, tlat, radius)
 
+        # each predicate is evaluated once; a restaurant hit by both shows up
+        # on both sides of the full join, and the same rows are inserted and
+        # returned
         TWEET_MATCH = """
-            SELECT id FROM ri_restaurants 
-            WHERE UPPER(name) = ANY(ARRAY[%s])
-            UNION
-            SELECT id FROM ri_restaurants 
-            WHERE box(%s) @> location;
-            """        
+            WITH name_hits AS (
+                SELECT id FROM ri_restaurants
+                WHERE UPPER(name) = ANY(%s::text[])
+            ), geo_hits AS (
+                SELECT id FROM ri_restaurants
+                WHERE box(%s) @> location
+                    AND 2 * %s * asin(least(1.0, sqrt(
+                        sin(radians(location[1] - %s) / 2) ^ 2 +
+                        cos(radians(%s)) * cos(radians(location[1])) *
+                        sin(radians(location[0] - %s) / 2) ^ 2))) <= %s
+            ), matches AS (
+                SELECT COALESCE(n.id, g.id) AS id,
+                    CASE WHEN g.id IS NULL THEN 'name'
+                         WHEN n.id IS NULL THEN 'geo'
+                         ELSE 'both' END::match_type AS match
+                FROM name_hits n
+                FULL OUTER JOIN geo_hits g
+                ON n.id = g.id
+            ), inserted AS (
+                INSERT INTO ri_tweetmatch (tkey, restaurant_id, match)
+                SELECT %s, id, match FROM matches
+                ON CONFLICT (tkey, restaurant_id) DO NOTHING
+            )
+            SELECT id FROM matches
+            ORDER BY id;
+            """
 
         try:
             cur.execute(TWEET_MATCH,
-                (tngram, box))
+                (tngram, box, EARTH_RADIUS, tlat, tlat, tlong, radius, tkey))
             r = cur.fetchall()
         except (Exception, DatabaseError) as e:
             status = self.bad_request(e, cur, rollback=True, status=400)
             return status, matched
 
-        if not r:
-            status = self.ok_request(cur, commit=False, status=200)
-            return status, matched
+        status = self.ok_request(cur, commit=bool(r), status=200)
+        for item in r:
+            matched.append(item['id'])
 
-        TWEET_INSERT = """
-            INSERT INTO ri_tweetmatch (tkey, restaurant_id, match)
+        return status, matched
 
-            (SELECT %s, id, 'both'::match_type FROM ri_restaurants 
-            WHERE UPPER(name) = ANY(ARRAY[%s])
-            INTERSECT
-            SELECT %s, id, 'both'::match_type FROM ri_restaurants 
-            WHERE box(%s) @> location)
 
-            UNION
+    def match_tweets(self, tweets, radius):
+        '''
+        Batched version of match_tweet. Stages the ngrams and bounding boxes
+        of every tweet in temp tables, matches them all against ri_restaurants
+        with one statement and inserts the matches into ri_tweetmatch in the
+        same pass. Returns a dictionary of tkey to matched restaurant ids.
+        '''
+
+        cur = self.conn.cursor(cursor_factory = RealDictCursor)
+        matched = {}
 
-            (SELECT %s, id, 'name'::match_type FROM ri_restaurants 
-            WHERE UPPER(name) = ANY(ARRAY[%s])
-            EXCEPT
-            SELECT %s, id, 'name'::match_type FROM ri_restaurants 
-            WHERE box(%s) @> location)
+        CREATE_TEMP = """
+            DROP TABLE IF EXISTS tweet_ngrams, tweet_boxes;
+            CREATE TEMP TABLE tweet_ngrams (
+                tkey varchar(50),
+                ngram text
+                );
+            CREATE TEMP TABLE tweet_boxes (
+                tkey varchar(50),
+                box box,
+                lon double precision,
+                lat double precision
+                );
+            """
+
+        STAGE_NGRAMS = """
+            INSERT INTO tweet_ngrams VALUES %s;
+            """
 
-            UNION
+        STAGE_BOXES = """
+            INSERT INTO tweet_boxes VALUES %s;
+            """
 
-            (SELECT %s, id, 'geo'::match_type FROM ri_restaurants 
-            WHERE box(%s) @> location
-            EXCEPT
-            SELECT %s, id, 'geo'::match_type FROM ri_restaurants 
-            WHERE UPPER(name) = ANY(ARRAY[%s]))
+        ANALYZE_TEMP = """
+            ANALYZE tweet_ngrams, tweet_boxes;
+            """
 
-            ON CONFLICT (tkey, restaurant_id) DO NOTHING;
+        # each predicate is evaluated once per tweet; a restaurant hit by
+        # both shows up on both sides of the full join
+        TWEETS_MATCH = """
+            WITH name_hits AS (
+                SELECT DISTINCT n.tkey, r.id
+                FROM tweet_ngrams n
+                JOIN ri_restaurants r
+                ON UPPER(r.name) = n.ngram
+            ), geo_hits AS (
+                SELECT DISTINCT b.tkey, r.id
+                FROM tweet_boxes b
+                JOIN ri_restaurants r
+                ON b.box @> r.location
+                    AND 2 * %s * asin(least(1.0, sqrt(
+                        sin(radians(r.location[1] - b.lat) / 2) ^ 2 +
+                        cos(radians(b.lat)) * cos(radians(r.location[1])) *
+                        sin(radians(r.location[0] - b.lon) / 2) ^ 2))) <= %s
+            ), matches AS (
+                SELECT COALESCE(n.tkey, g.tkey) AS tkey,
+                    COALESCE(n.id, g.id) AS id,
+                    CASE WHEN g.id IS NULL THEN 'name'
+                         WHEN n.id IS NULL THEN 'geo'
+                         ELSE 'both' END::match_type AS match
+                FROM name_hits n
+                FULL OUTER JOIN geo_hits g
+                ON n.tkey = g.tkey AND n.id = g.id
+            ), inserted AS (
+                INSERT INTO ri_tweetmatch (tkey, restaurant_id, match)
+                SELECT tkey, id, match FROM matches
+                ON CONFLICT (tkey, restaurant_id) DO NOTHING
+            )
+            SELECT tkey, id
+            FROM matches
+            ORDER BY tkey, id;
             """
 
+        ngram_rows = []
+        box_rows = []
+        for t in tweets:
+            matched[t['tkey']] = []
+            ngram_rows.extend((t['tkey'], n) for n in set(t['ngram']))
+            box = tweet_box(t['long'], t['lat'], radius)
+            if box:
+                box_rows.append((t['tkey'], box, t['long'], t['lat']))
+
         try:
-            cur.execute(TWEET_INSERT,
-                    (tkey, tngram, tkey, box,
-                     tkey, tngram, tkey, box,
-                     tkey, box, tkey, tngram))
+            cur.execute(CREATE_TEMP)
+            if ngram_rows:
+                execute_values(cur, STAGE_NGRAMS, ngram_rows, page_size=1000)
+            if box_rows:
+                execute_values(cur, STAGE_BOXES, box_rows, page_size=1000)
+            cur.execute(ANALYZE_TEMP)
+            cur.execute(TWEETS_MATCH, (EARTH_RADIUS, radius))
+            r = cur.fetchall()
         except (Exception, DatabaseError) as e:
             status = self.bad_request(e, cur, rollback=True, status=400)
             return status, matched
 
         status = self.ok_request(cur, commit=True, status=200)
         for item in r:
-            matched.append(item['id'])
+            matched[item['tkey']].append(item['id'])
 
         return status, matched
 
@@ -499,7 +1558,8 @@ class DB:
     def add_restaurants_index(self):
         '''
         Create two indexes for the restaurant tables if they don't already exist
-        One for restaurant names and one for location.
+        One for restaurant names and one for location. Also create the indexes
+        behind the search endpoints.
         '''
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
@@ -519,11 +1579,27 @@ class DB:
         except (Exception, DatabaseError) as e:
             return self.bad_request(e, cur, rollback=True, status=400)
 
+        CREATE_SEARCH_IDX = """
+            CREATE INDEX IF NOT EXISTS ri_restaurants_name_prefix_idx
+            ON ri_restaurants (UPPER(name) text_pattern_ops);
+            CREATE INDEX IF NOT EXISTS ri_restaurants_zip_idx
+            ON ri_restaurants (zip, state);
+            CREATE INDEX IF NOT EXISTS ri_inspections_date_idx
+            ON ri_inspections (inspection_date DESC, id DESC);
+            CREATE INDEX IF NOT EXISTS ri_inspections_results_date_idx
+            ON ri_inspections (results, inspection_date DESC, id DESC);
+            """
+
         try:
             cur.execute(CREATE_REST_LOC_IDX)
         except (Exception, DatabaseError) as e:
             return self.bad_request(e, cur, rollback=True, status=400)
 
+        try:
+            cur.execute(CREATE_SEARCH_IDX)
+        except (Exception, DatabaseError) as e:
+            return self.bad_request(e, cur, rollback=True, status=400)
+
         status = self.ok_request(cur, commit=True, status=200)
 
         return status
@@ -562,12 +1638,11 @@ class DB:
 
     def find_linked_restaurants(self):
         '''
-        Iterate through all not-clean restaurant records and compare with 
-        other not-clean restaurant records using text distance algorithms.
-        If multiple records are deemed similar enough according to text
-        distance algorithms, output them as a dictionary of matches 
-        (primary id = restaurant id with the longest name) and
-        update the clean flag in ri_restaurants.
+        Load all not-clean restaurant records once and cluster the ones that
+        text distance algorithms deem similar (see match_records.link_records).
+        Output the clusters as a list of dictionaries of matches
+        (primary id = restaurant id with the longest name) and update the
+        clean flag in ri_restaurants with one statement.
         '''
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
@@ -575,14 +1650,15 @@ class DB:
         status = None
 
         DIRTY_RECORDS = """
-            SELECT * FROM ri_restaurants 
-            WHERE clean = false;
+            SELECT id, name, address, state, zip FROM ri_restaurants 
+            WHERE clean = false
+            ORDER BY id;
             """
 
         UPDATE_RECORDS = """
             UPDATE ri_restaurants
             SET clean = true 
-            WHERE id = ANY(ARRAY[%s]);
+            WHERE id = ANY(%s);
             """
 
         try:
@@ -592,35 +1668,47 @@ class DB:
             status = self.bad_request(e, cur, rollback=False, status=400)
             return status, matches
 
-        while len(r) >= 1:
-            i = r[0]
-            linked_dict = {'primary': i['id'], 'linked': [i['id']]}
-            for j in r[1:]:
-                if match_records.check_match(i, j):
-                    linked_dict['linked'].append(j['id'])
-                    if len(j['name']) > len(i['name']):
-                        linked_dict['primary'] = j['id']
+        matches = match_records.link_records(r)
 
-            try:
-                cur.execute(UPDATE_RECORDS, (linked_dict['linked'],))
-            except (Exception, DatabaseError) as e:
-                status = self.bad_request(e, cur, rollback=True, status=400)
-                return status, matches
-
-            matches.append(linked_dict)
-
-            try:
-                cur.execute(DIRTY_RECORDS)
-                r = cur.fetchall()
-            except (Exception, DatabaseError) as e:
-                status = self.bad_request(e, cur, rollback=False, status=400)
-                return status, matches
+        try:
+            cur.execute(UPDATE_RECORDS, ([i['id'] for i in r],))
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=True, status=400)
+            return status, matches
 
         status = self.ok_request(cur, commit=False, status=200)
 
         return status, matches
 
 
+    def refresh_summaries(self, cur, restaurant_ids):
+        '''
+        Recompute the ri_restaurant_summary rows of restaurants whose
+        inspections were moved to another restaurant. Restaurants left without
+        inspections lose their row.
+        '''
+
+        if not restaurant_ids:
+            return
+
+        DELETE_SUMMARIES = """
+            DELETE FROM ri_restaurant_summary
+            WHERE restaurant_id = ANY(%s);
+            """
+
+        REBUILD_SUMMARIES = """
+            WITH inserted AS (
+                SELECT *
+                FROM ri_inspections
+                WHERE restaurant_id = ANY(%s)
+            )
+            """ + SUMMARY_UPSERT
+
+        ids = list(restaurant_ids)
+        cur.execute(DELETE_SUMMARIES, (ids,))
+        cur.execute(REBUILD_SUMMARIES, (ids,))
+
+
     def find_and_update_linked_restaurants(self):
         '''
         After finding all similar restaurants, update ri_linked with pairs 
@@ -629,31 +1717,39 @@ class DB:
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
         status, matches = self.find_linked_restaurants()
+        if status >= 400:
+            cur.close()
+            return status
 
         INSERT_LINKED_RECORDS = """
             INSERT INTO ri_linked (primary_rest_id, original_rest_id)
-            VALUES
-            (%s, %s);
+            VALUES %s;
             """
 
         UPDATE_INSPECTIONS = """
             UPDATE ri_inspections AS i
             SET restaurant_id  = l.primary_rest_id
             FROM ri_linked l 
-            WHERE i.restaurant_id = l.original_rest_id;
+            WHERE i.restaurant_id = l.original_rest_id
+            RETURNING l.primary_rest_id, l.original_rest_id;
             """
 
-        for m in matches:
-            for l in m['linked']:
-                if m['primary'] != l:
-                    try:
-                        cur.execute(INSERT_LINKED_RECORDS, (m['primary'], l))
-                    except (Exception, DatabaseError) as e:
-                        status = self.bad_request(e, cur, rollback=True, status=400)
-                        return status         
+        linked = [(m['primary'], l) for m in matches
+                  for l in m['linked'] if m['primary'] != l]
+
+        try:
+            if linked:
+                execute_values(cur, INSERT_LINKED_RECORDS, linked, page_size=1000)
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=True, status=400)
+            return status
 
         try:
             cur.execute(UPDATE_INSPECTIONS)
+            moved = cur.fetchall()
+            self.refresh_summaries(cur,
+                set(r['primary_rest_id'] for r in moved) |
+                set(r['original_rest_id'] for r in moved))
         except (Exception, DatabaseError) as e:
             status = self.bad_request(e, cur, rollback=True, status=400)
             return status
@@ -758,130 +1854,115 @@ class DB:
         return status, restaurants
 
 
-    def find_linked_restaurants_fast(self):
+    def find_linked_restaurants_fast(self, workers=1, strategies=('zip',), window=5, report=None):
         '''
-        Iterate through all not-clean restaurant records with blocking and
-        compare with other not-clean restaurant records using text distance
-        algorithms. If multiple records are deemed similar enough according to text
-        distance algorithms, output them as a dictionary of matches 
-        (primary id = restaurant id with the longest name) and
-        update the clean flag in ri_restaurants.
+        Load all not-clean restaurant records (and the primaries of earlier
+        runs) once, block them by state and zip and link each block with
+        match_records.link_block, comparing records with text distance
+        algorithms. If multiple records are deemed similar enough, output
+        them as a dictionary of matches (primary = the longest name). Blocks
+        are independent, so with workers > 1 they are linked in a pool of
+        that many processes.
+
+        strategies and window pick the blocking passes run within each
+        block; the candidate pair counts of the run are stored in the report
+        dictionary, if given.
         '''
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
-        states = match_records.blocking(self.conn, cur)
         matches = []
         status = None
 
         DIRTY_RECORDS = """
-            SELECT * FROM {}
+            SELECT id, name, facility_type, address, city, state, zip, location
+            FROM ri_restaurants 
             WHERE clean = false
-            AND zip = %s;
+            OR id IN (SELECT primary_rest_id 
+                      FROM ri_linked)
+            ORDER BY id;
             """
 
-        UPDATE_TEMP_RECORDS = """
-            UPDATE {}
-            SET clean = true 
-            WHERE id = ANY(ARRAY[%s])
-            AND zip = %s;
-            """
+        try:
+            cur.execute(DIRTY_RECORDS)
+            r = cur.fetchall()
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=False, status=400)
+            return status, matches
 
-        for s in states:
-            for z in states[s]: 
-                try:
-                    cur.execute(sql.SQL(DIRTY_RECORDS).format(sql.Identifier(s)), (z,))
-                    r = cur.fetchall()
-                except (Exception, DatabaseError) as e:
-                    status = self.bad_request(e, cur, rollback=False, status=400)
-                    return status, matches
-
-                while len(r) >= 1:
-                    i = r[0]
-                    a_i = str(i['address']).split(' ')
-                    n_i, s_i = (a_i[0], a_i[1:])
-                    linked_dict = {'primary_name': i['name'],
-                                   'types': {i['facility_type']: 1},
-                                   'primary_type': i['facility_type'],
-                                   'primary_street': s_i,
-                                   'street_nums': {n_i: 1}, 
-                                   'primary_num': n_i,
-                                   'cities': {i['city']: 1},  
-                                   'primary_city': i['city'],                             
-                                   'primary_state': s[0:2],
-                                   'primary_zip': i['zip'],
-                                   'primary_loc': i['location'],
-                                   'linked': [i['id']]}
-
-                    for j in r[1:]:
-                        if match_records.check_match_fast(i, j):
-                            a_j = str(j['address']).split(' ')
-                            n_j, s_j = (a_j[0], a_j[1:])
-                            linked_dict['linked'].append(j['id'])
-
-                            linked_dict['primary_num'] = match_records.find_most_common(
-                                linked_dict['street_nums'], n_j, linked_dict['primary_num'])
-                                
-                            linked_dict['primary_type'] = match_records.find_most_common(
-                                linked_dict['types'], j['facility_type'], linked_dict['primary_type'])
-
-                            linked_dict['primary_city'] = match_records.find_most_common(
-                                linked_dict['cities'], j['city'], linked_dict['primary_city'])
-
-                            if len(j['name']) > len(linked_dict['primary_name']):
-                                linked_dict['primary_name'] = j['name']
-                            if len(s_j) > len(linked_dict['primary_street']):
-                                linked_dict['primary_street'] = s_j
-                            if len(j['location']) > len(linked_dict['primary_loc']):
-                                linked_dict['primary_loc'] = j['location']
-
-                    try:
-                        cur.execute(sql.SQL(UPDATE_TEMP_RECORDS).format(
-                            sql.Identifier(s)), (linked_dict['linked'], z))
-                    except (Exception, DatabaseError) as e:
-                        status = self.bad_request(e, cur, rollback=True, status=400)
-                        return status, matches
-
-                    linked_dict['primary_add'] = linked_dict['primary_num'] + ' ' + ' '.join(linked_dict['primary_street'])[:-1]
-                    matches.append(linked_dict)
-
-                    try:
-                        cur.execute(sql.SQL(DIRTY_RECORDS).format(sql.Identifier(s)), (z,))
-                        r = cur.fetchall()
-                    except (Exception, DatabaseError) as e:
-                        status = self.bad_request(e, cur, rollback=False, status=400)
-                        return status, matches
+        blocks = {}
+        for i in r:
+            blocks.setdefault((i['state'], i['zip']), []).append(dict(i))
+        # largest blocks first so the pool is not left waiting on one
+        blocks = sorted(blocks.values(), key=len, reverse=True)
+
+        args = (blocks, [strategies] * len(blocks), [window] * len(blocks))
+        if workers > 1 and len(blocks) > 1:
+            # workers start from a fresh process rather than a fork of this
+            # threaded server, whose locks and pool connections they would
+            # inherit
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() \
+                else 'spawn'
+            with ProcessPoolExecutor(max_workers=min(workers, len(blocks)),
+                                     mp_context=multiprocessing.get_context(method)) as executor:
+                linked = list(executor.map(match_records.link_block, *args))
+        else:
+            linked = list(map(match_records.link_block, *args))
+
+        for block_matches, _ in linked:
+            matches.extend(block_matches)
+
+        totals = match_records.merge_reports(r for _, r in linked)
+        logging.info("Linked %s records in %s blocks: %s of %s pairs compared (%s), %s matched",
+                     totals['records'], totals['blocks'], totals['candidates'],
+                     totals['all_pairs'],
+                     ', '.join('%s %s' % (k, v['pairs']) for k, v in totals['strategies'].items()),
+                     totals['matches'])
+        if report is not None:
+            report.clear()
+            report.update(totals)
 
         status = self.ok_request(cur, commit=False, status=200)
 
         return status, matches
 
 
-    def find_and_update_linked_restaurants_fast(self):
+    def find_and_update_linked_restaurants_fast(self, workers=1, strategies=('zip',), window=5, report=None):
         '''
         After finding all similar restaurants, update ri_linked with pairs 
         of similar restaurants and update ri_restaurants with primary ids. 
+        The primary records and the ri_linked pairs are each written with a
+        single statement.
         '''
 
         cur = self.conn.cursor(cursor_factory = RealDictCursor)
-        status, matches = self.find_linked_restaurants_fast()
+        status, matches = self.find_linked_restaurants_fast(workers, strategies, window, report)
+        if status >= 400:
+            cur.close()
+            return status
 
-        INSERT_PRIMARY_RECORD = """
+        INSERT_PRIMARY_RECORDS = """
             INSERT INTO ri_restaurants (name, facility_type, address, zip, city, state, location, clean)
-            VALUES
-            (%s, %s, %s, %s, %s, %s, %s, true);
+            VALUES %s
+            ON CONFLICT (name, address) DO UPDATE SET clean = true
+            RETURNING id, name, address;
+            """
+
+        PRIMARY_TEMPLATE = """
+            (%s, %s, %s, %s, %s, %s, %s, true)
             """
 
         INSERT_LINKED_RECORDS = """
             INSERT INTO ri_linked (primary_rest_id, original_rest_id)
-            VALUES
-            (%s, %s);
+            VALUES %s
+            ON CONFLICT DO NOTHING;
             """
 
         UPDATE_INSPECTIONS = """
             UPDATE ri_inspections AS i
             SET restaurant_id  = l.primary_rest_id
             FROM ri_linked l 
-            WHERE i.restaurant_id = l.original_rest_id;
+            WHERE i.restaurant_id = l.original_rest_id
+            RETURNING l.primary_rest_id, l.original_rest_id;
             """
 
         UPDATE_RESTAURANTS = """
@@ -891,32 +1972,48 @@ class DB:
                          FROM ri_linked);
             """
 
+        # an upsert may only touch each (name, address) once per statement
+        primaries = {}
         for m in matches:
             if len(m['linked']) >= 2:
-                try:
-                    cur.execute(INSERT_PRIMARY_RECORD, (m['primary_name'],
-                                                        m['primary_type'],
-                                                        m['primary_add'],
-                                                        m['primary_zip'],
-                                                        m['primary_city'],
-                                                        m['primary_state'],
-                                                        m['primary_loc']))
-
-                    cur.execute("""SELECT max(id) FROM ri_restaurants;""")
-                    idx = cur.fetchone()['max']
-                except (Exception, DatabaseError) as e:
-                    status = self.bad_request(e, cur, rollback=True, status=400)
-                    return status  
-
-                for l in m['linked']:
-                    try:
-                        cur.execute(INSERT_LINKED_RECORDS, (idx, l))
-                    except (Exception, DatabaseError) as e:
-                        status = self.bad_request(e, cur, rollback=True, status=400)
-                        return status         
+                primaries.setdefault((m['primary_name'], m['primary_add']),
+                                     (m['primary_name'],
+                                      m['primary_type'],
+                                      m['primary_add'],
+                                      m['primary_zip'],
+                                      m['primary_city'],
+                                      m['primary_state'],
+                                      m['primary_loc']))
+
+        try:
+            ids = {}
+            if primaries:
+                rows = execute_values(cur, INSERT_PRIMARY_RECORDS,
+                                      list(primaries.values()),
+                                      template=PRIMARY_TEMPLATE,
+                                      page_size=len(primaries), fetch=True)
+                ids = dict(((p['name'], p['address']), p['id']) for p in rows)
+
+            # the primary may already exist as one of the originals
+            linked = set()
+            for m in matches:
+                if len(m['linked']) >= 2:
+                    idx = ids[(m['primary_name'], m['primary_add'])]
+                    linked.update((idx, l) for l in m['linked'] if l != idx)
+
+            if linked:
+                execute_values(cur, INSERT_LINKED_RECORDS, list(linked),
+                               page_size=1000)
+        except (Exception, DatabaseError) as e:
+            status = self.bad_request(e, cur, rollback=True, status=400)
+            return status
 
         try:
             cur.execute(UPDATE_INSPECTIONS)
+            moved = cur.fetchall()
+            self.refresh_summaries(cur,
+                set(r['primary_rest_id'] for r in moved) |
+                set(r['original_rest_id'] for r in moved))
         except (Exception, DatabaseError) as e:
             status = self.bad_request(e, cur, rollback=True, status=400)
             return status
@@ -925,7 +2022,7 @@ class DB:
             cur.execute(UPDATE_RESTAURANTS)
         except (Exception, DatabaseError) as e:
             status = self.bad_request(e, cur, rollback=True, status=400)
-            return status, matches
+            return status
 
 
         status = self.ok_request(cur, commit=True, status=200)
@@ -3,8 +3,31 @@ Provides a linear model for determining record matches for use in db.py
 '''
 
 from textdistance import jaro, jaro_winkler, smith_waterman
-import logging
-from psycopg2 import DatabaseError, sql
+
+# optional compiled backend for scoring whole blocks, see score_rows
+try:
+    import numpy as np
+    from rapidfuzz import process
+    from rapidfuzz.distance import Jaro, JaroWinkler
+except ImportError:
+    process = None
+
+MATCH_THRESHOLD = 8.75
+
+# rows of a block scored at once by match_pairs, bounding memory to
+# SCORE_ROWS x block size scores
+SCORE_ROWS = 1024
+
+# blocking passes run within each (state, zip) block by link_block: 'zip'
+# compares every pair, so it is used on its own, 'building' pairs records with the same building
+# number, 'soundex' records whose names share a soundex code and
+# 'neighbourhood' records within a window of each other when sorted by
+# normalised name
+BLOCKING_STRATEGIES = ('zip', 'building', 'soundex', 'neighbourhood')
+
+SOUNDEX_CODES = dict((c, str(code)) for code, letters in
+                     enumerate(['AEIOUYHW', 'BFPV', 'CGJKQSXZ', 'DT', 'L', 'MN', 'R'])
+                     for c in letters)
 
 
 def check_match(r1, r2):
@@ -26,7 +49,7 @@ def check_match(r1, r2):
 
         total_score = 2.5*building_score + 2.5*street_score + 5*name_score
 
-        if total_score >= 8.75:
+        if total_score >= MATCH_THRESHOLD:
             return True
         else:
             return False
@@ -44,7 +67,7 @@ def check_match_fast(r1, r2):
 
     total_score = 2.5*building_score + 2.5*street_score + 5*name_score
 
-    if total_score >= 8.75:
+    if total_score >= MATCH_THRESHOLD:
         return True
     else:
         return False
@@ -71,70 +94,307 @@ def address_split(a1, a2):
     b2, s2 = (a2[0], str(a2[1:]))
     return b1, b2, s1, s2
 
-def blocking(conn, cur):
-    '''
-    Create a temp table for every state within our dataset and dump the relevant
-    dirty data into each temp table for future record linkage.
-    '''
-
-    GET_STATES = """
-        SELECT distinct(state)
-        FROM ri_restaurants;
-        """
-
-    CREATE_TEMP_TABLE = """
-        CREATE TEMP TABLE {} 
-        AS
-        SELECT id, name, facility_type, address, city, state, zip, location, false as clean
-        FROM ri_restaurants 
-        WHERE state = %s
-            AND ( clean = false OR id IN ( SELECT primary_rest_id 
-                                           FROM ri_linked )
-                );
-        """
-
-    CREATE_TEMP_INDEX = """
-        CREATE INDEX ON {} USING hash (zip);
-        """
-
-    GET_ZIPCODES = """
-        SELECT DISTINCT zip FROM {};
-        """
-
-    try:
-        cur.execute(GET_STATES)
-    except (Exception, DatabaseError) as e:
-        status = bad_request(e, conn, cur, rollback=True, status=400)
-        return []
-
-    # convert list of state dicts to list of states
-    states_dicts = cur.fetchall()
-    temp_names = [x['state'] + '_block' for x in states_dicts]
-    states = [x['state'] for x in states_dicts]
-    temp_zips = {}
-
-    try:
-        for temp_name, state in zip(temp_names, states):
-            cur.execute(
-                sql.SQL(CREATE_TEMP_TABLE)
-                    .format(sql.Identifier(temp_name)),
-                (state,))
-            cur.execute(
-                sql.SQL(CREATE_TEMP_INDEX)
-                    .format(sql.Identifier(temp_name))
-                )
-            cur.execute(
-                sql.SQL(GET_ZIPCODES)
-                    .format(sql.Identifier(temp_name))
-                )
-            zip_dicts = cur.fetchall()
-            state_zips = [x['zip'] for x in zip_dicts]
-            temp_zips[temp_name] = state_zips
-    except (Exception, DatabaseError) as e:
-        status = bad_request(e, conn, cur, rollback=True, status=500)
-        return []
-
-    return temp_zips
+def find_root(parent, x):
+    '''
+    Find the representative of x in a union-find parent map, halving the
+    path on the way.
+    '''
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+def cluster(ids, pairs):
+    '''
+    Merge matched (id, id) pairs with union-find and return the clusters as
+    lists of ids, ordered by their first appearance in ids. Ids without a
+    match come back as clusters of one.
+    '''
+    parent = dict((i, i) for i in ids)
+    for a, b in pairs:
+        root_a, root_b = find_root(parent, a), find_root(parent, b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    clusters = {}
+    for i in ids:
+        clusters.setdefault(find_root(parent, i), []).append(i)
+    return list(clusters.values())
+
+def normalize_block(records):
+    '''
+    Upper-case the names, building numbers and streets of a block's records
+    once, exactly as get_name_score, get_building_score and get_street_score
+    see them (the street is the string of the list of its words, as
+    address_split makes it).
+    '''
+    names, buildings, streets = [], [], []
+    for r in records:
+        a = str(r['address']).split(' ')
+        names.append(r['name'].upper())
+        buildings.append(a[0].upper())
+        streets.append(str(a[1:]).upper())
+    return names, buildings, streets
+
+def score_rows(normalized, start, end):
+    '''
+    Score records start to end of a normalized block with the linear model of
+    check_match_fast. With rapidfuzz installed this returns a numpy matrix of
+    their scores against every record of the block. Otherwise only the pairs
+    needed are scored, with textdistance: row x holds the scores against the
+    records after x.
+    '''
+    names, buildings, streets = normalized
+    if process is not None:
+        name_scores = process.cdist(names[start:end], names,
+                                    scorer=Jaro.normalized_similarity, dtype=np.float64)
+        building_scores = process.cdist(buildings[start:end], buildings,
+                                        scorer=JaroWinkler.normalized_similarity, dtype=np.float64)
+        street_scores = process.cdist(streets[start:end], streets,
+                                      scorer=JaroWinkler.normalized_similarity, dtype=np.float64)
+        return 2.5*building_scores + 2.5*street_scores + 5*name_scores
+
+    return [[2.5*jaro_winkler.normalized_similarity(buildings[x], buildings[y]) +
+             2.5*jaro_winkler.normalized_similarity(streets[x], streets[y]) +
+             5*jaro.normalized_similarity(names[x], names[y])
+             for y in range(x + 1, len(names))]
+            for x in range(start, end)]
+
+def match_pairs(records):
+    '''
+    Find the matching pairs of a block, applying the match threshold to a
+    whole slice of the score matrix at a time. Returns (x, y) positions in
+    records with x < y.
+    '''
+    normalized = normalize_block(records)
+    pairs = []
+    for start in range(0, len(records), SCORE_ROWS):
+        end = min(start + SCORE_ROWS, len(records))
+        scores = score_rows(normalized, start, end)
+        if process is not None:
+            xs, ys = np.nonzero(scores >= MATCH_THRESHOLD)
+            pairs.extend((start + x, y) for x, y in zip(xs.tolist(), ys.tolist())
+                         if start + x < y)
+            continue
+
+        for x, row in enumerate(scores, start):
+            pairs.extend((x, y) for y, score in enumerate(row, x + 1)
+                         if score >= MATCH_THRESHOLD)
+    return pairs
+
+def normalize_name(name):
+    '''
+    Upper-case a name, keep only letters, digits and single spaces and drop a
+    leading "THE", so "The Joe's  Grill" and "JOES GRILL" sort together.
+    '''
+    name = ''.join(c if c.isalnum() else ' ' if c.isspace() else ''
+                   for c in name.upper())
+    words = name.split()
+    if len(words) > 1 and words[0] == 'THE':
+        words = words[1:]
+    return ' '.join(words)
+
+def soundex(name):
+    '''
+    American soundex code of a name's letters, eg "ROBERT" -> "R163".
+    '''
+    letters = [c for c in name.upper() if c in SOUNDEX_CODES]
+    if not letters:
+        return ''
+
+    code = letters[0]
+    last = SOUNDEX_CODES[letters[0]]
+    for c in letters[1:]:
+        digit = SOUNDEX_CODES[c]
+        if digit != '0' and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        # H and W do not separate letters with the same code
+        if c not in 'HW':
+            last = digit
+    return code.ljust(4, '0')
+
+def candidate_pairs(records, strategies, window=5):
+    '''
+    Run the blocking passes named in strategies over a block and return the
+    candidate (x, y) positions, x < y, deduplicated across passes, along
+    with a count per strategy of the pairs it proposed and of those no
+    earlier pass had.
+    '''
+    candidates = set()
+    counts = {}
+
+    for strategy in strategies:
+        if strategy == 'neighbourhood':
+            order = sorted(range(len(records)),
+                           key=lambda x: (normalize_name(records[x]['name']), x))
+            proposed = set()
+            for k, x in enumerate(order):
+                for y in order[k + 1:k + window]:
+                    proposed.add((min(x, y), max(x, y)))
+        else:
+            if strategy == 'zip':
+                key = lambda r: ''
+            elif strategy == 'building':
+                key = lambda r: str(r['address']).split(' ')[0].upper()
+            elif strategy == 'soundex':
+                key = lambda r: soundex(r['name'])
+            else:
+                raise ValueError('Unknown blocking strategy: %s' % strategy)
+
+            groups = {}
+            for x, r in enumerate(records):
+                groups.setdefault(key(r), []).append(x)
+            proposed = set((group[a], group[b]) for group in groups.values()
+                           for a in range(len(group))
+                           for b in range(a + 1, len(group)))
+
+        counts[strategy] = {'pairs': len(proposed),
+                            'new': len(proposed - candidates)}
+        candidates |= proposed
+
+    return candidates, counts
+
+def score_pairs(normalized, pairs):
+    '''
+    Score the given (x, y) positions of a normalized block with the linear
+    model of check_match_fast, returning the pairs at or above the match
+    threshold.
+    '''
+    names, buildings, streets = normalized
+    if process is not None:
+        name_score, jw_score = Jaro.normalized_similarity, JaroWinkler.normalized_similarity
+    else:
+        name_score, jw_score = jaro.normalized_similarity, jaro_winkler.normalized_similarity
+
+    matched = []
+    for x, y in pairs:
+        score = 2.5*jw_score(buildings[x], buildings[y]) + \
+                2.5*jw_score(streets[x], streets[y]) + \
+                5*name_score(names[x], names[y])
+        if score >= MATCH_THRESHOLD:
+            matched.append((x, y))
+    return matched
+
+def block_pairs(block):
+    '''
+    Compare every pair of records in a block and return the (id, id) pairs
+    that match.
+    '''
+    return [(block[x]['id'], block[y]['id']) for x, y in match_pairs(block)]
+
+def link_records(records):
+    '''
+    Cluster records in one pass. Records are blocked by state and zip in
+    memory (check_match never matches across those), compared pairwise within
+    each block, and matched pairs are merged with union-find, so matches are
+    transitive. Returns a list of {'primary': id, 'linked': [ids]} where the
+    primary is the record with the longest name.
+    '''
+    blocks = {}
+    for r in records:
+        blocks.setdefault((r['state'], r['zip']), []).append(r)
+
+    pairs = []
+    for block in blocks.values():
+        pairs.extend(block_pairs(block))
+
+    names = dict((r['id'], r['name']) for r in records)
+    matches = []
+    for ids in cluster([r['id'] for r in records], pairs):
+        primary = max(ids, key=lambda i: (len(names[i]), -i))
+        matches.append({'primary': primary, 'linked': ids})
+    return matches
+
+def link_group(records):
+    '''
+    Build the primary record of a group of linked records: the longest name,
+    street and location and the most common building number, facility type
+    and city.
+    '''
+    i = records[0]
+    a_i = str(i['address']).split(' ')
+    n_i, s_i = (a_i[0], a_i[1:])
+    linked_dict = {'primary_name': i['name'],
+                   'types': {i['facility_type']: 1},
+                   'primary_type': i['facility_type'],
+                   'primary_street': s_i,
+                   'street_nums': {n_i: 1},
+                   'primary_num': n_i,
+                   'cities': {i['city']: 1},
+                   'primary_city': i['city'],
+                   'primary_state': i['state'],
+                   'primary_zip': i['zip'],
+                   'primary_loc': i['location'],
+                   'linked': [i['id']]}
+
+    for j in records[1:]:
+        a_j = str(j['address']).split(' ')
+        n_j, s_j = (a_j[0], a_j[1:])
+        linked_dict['linked'].append(j['id'])
+
+        linked_dict['primary_num'] = find_most_common(
+            linked_dict['street_nums'], n_j, linked_dict['primary_num'])
+
+        linked_dict['primary_type'] = find_most_common(
+            linked_dict['types'], j['facility_type'], linked_dict['primary_type'])
+
+        linked_dict['primary_city'] = find_most_common(
+            linked_dict['cities'], j['city'], linked_dict['primary_city'])
+
+        if len(j['name']) > len(linked_dict['primary_name']):
+            linked_dict['primary_name'] = j['name']
+        if len(s_j) > len(linked_dict['primary_street']):
+            linked_dict['primary_street'] = s_j
+        if len(j['location'] or '') > len(linked_dict['primary_loc'] or ''):
+            linked_dict['primary_loc'] = j['location']
+
+    linked_dict['primary_add'] = linked_dict['primary_num'] + ' ' + ' '.join(linked_dict['primary_street'])[:-1]
+    return linked_dict
+
+def link_block(records, strategies=('zip',), window=5):
+    '''
+    Link the records of one (state, zip) block. Only needs its arguments, so
+    blocks can be linked in separate processes. Returns the list of linked
+    groups (see link_group) and a report of the pairs compared.
+
+    With the default 'zip' strategy every pair is scored; other strategies
+    only score the candidate pairs their blocking passes propose. Either way
+    the matched pairs are merged with union-find, so matches are transitive.
+    '''
+    n = len(records)
+    report = {'records': n, 'all_pairs': n * (n - 1) // 2}
+
+    if 'zip' in strategies:
+        pairs = match_pairs(records)
+        report['strategies'] = {'zip': {'pairs': report['all_pairs'],
+                                        'new': report['all_pairs']}}
+        report['candidates'] = report['all_pairs']
+    else:
+        candidates, report['strategies'] = candidate_pairs(records, strategies, window)
+        pairs = score_pairs(normalize_block(records), sorted(candidates))
+        report['candidates'] = len(candidates)
+    report['matches'] = len(pairs)
+
+    groups = cluster(list(range(n)), pairs)
+    return [link_group([records[x] for x in group]) for group in groups], report
+
+def merge_reports(reports):
+    '''
+    Add up the link_block reports of many blocks.
+    '''
+    total = {'blocks': 0, 'records': 0, 'all_pairs': 0, 'candidates': 0,
+             'matches': 0, 'strategies': {}}
+    for report in reports:
+        total['blocks'] += 1
+        for k in ('records', 'all_pairs', 'candidates', 'matches'):
+            total[k] += report[k]
+        for strategy, counts in report['strategies'].items():
+            strategy_total = total['strategies'].setdefault(strategy, {'pairs': 0, 'new': 0})
+            strategy_total['pairs'] += counts['pairs']
+            strategy_total['new'] += counts['new']
+    return total
 
 def find_most_common(d, new_key, primary_key):
     ''' Helper function to find the most common key in a dict
@@ -148,33 +408,6 @@ def find_most_common(d, new_key, primary_key):
 
     return primary_key
 
-def bad_request(e, conn, cur, rollback=True, status=400):
-    """
-    Helper function to handle bad request: rollback, close cursor,
-    return correct status.
-    """
-
-    logging.error("DB error: %s", e)
-    logging.error("Query attempted: %s", cur.query)
-    if rollback:
-        conn.rollback()
-    cur.close()
-
-    return status
-
-
-def ok_request(cur, commit=True, status=200):
-    """
-    Helper function to handle OK request: commit, close cursor,
-    return correct status.
-    """
-
-    if commit:
-        self.conn.commit()
-    cur.close()
-
-    return status
-
 
 if __name__ == "__main__":
     '''
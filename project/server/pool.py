@@ -0,0 +1,238 @@
+'''
+Provides a thread-safe pool of database connections for use in server.py,
+along with the per-connection transaction batching state behind /txn.
+'''
+
+import logging
+import os
+import threading
+import time
+import psycopg2 as pg
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    '''
+    Raised when no suitable connection is returned to the pool in time.
+    '''
+
+
+class ConnectionPool:
+    '''
+    Hands out psycopg2 connections to request handlers. At least minconn
+    connections are kept open and at most maxconn are ever opened; a caller
+    asking for a connection while all maxconn are checked out waits for one
+    to be returned, for at most timeout seconds.
+
+    Batched loads (see /txn) are tracked per connection: a connection that
+    has uncommitted loads keeps its transaction open when it is returned to
+    the pool, and is committed once txnsize loads have accumulated on it.
+    The keys each load touched are passed to on_settle once its transaction
+    commits or rolls back, so that caches can drop them at that point.
+    '''
+
+    def __init__(self, minconn, maxconn, timeout=30, on_settle=None, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.dsn = dsn
+        self.txnsize = 1
+        self.idle = []
+        self.pending = {}
+        self.touched = {}
+        self.on_settle = on_settle
+        self.size = 0
+        self.closed = False
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+
+        for _ in range(minconn):
+            self.idle.append(pg.connect(**self.dsn))
+            self.size += 1
+
+
+    def getconn(self, clean=False, loads=False):
+        '''
+        Check a connection out of the pool, opening a new one if none are
+        idle and the pool is not full. Connections without pending loads are
+        preferred; a reader only shares one holding pending loads when the
+        pool is full. With clean=True only a connection without pending loads
+        is handed out, for callers that commit or roll back on their own.
+        With loads=True the most recently used connection comes first, so
+        batched loads keep landing on the connection that already holds
+        their open transaction. Raises PoolTimeout after waiting timeout
+        seconds.
+        '''
+
+        deadline = time.monotonic() + self.timeout
+        with self.cond:
+            while True:
+                for k in range(len(self.idle) - 1, -1, -1):
+                    if loads or not self.pending.get(id(self.idle[k])):
+                        return self.idle.pop(k)
+                if self.size < self.maxconn:
+                    break
+                if self.idle and not clean:
+                    return self.idle.pop()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("No %sdatabase connection free after %ss" %
+                                      ('clean ' if clean else '', self.timeout))
+                self.cond.wait(remaining)
+            self.size += 1
+
+        try:
+            return pg.connect(**self.dsn)
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify_all()
+            raise
+
+
+    def putconn(self, conn):
+        '''
+        Return a connection to the pool. Any transaction left open by reads is
+        ended unless the connection holds loads waiting to be committed.
+        '''
+
+        if self.closed and not conn.closed:
+            conn.close()
+
+        if conn.closed:
+            with self.cond:
+                self.pending.pop(id(conn), None)
+                keys = self.touched.pop(id(conn), None)
+                self.size -= 1
+                self.cond.notify_all()
+            self.settle(keys)
+            return
+
+        try:
+            if not self.pending.get(id(conn)) and \
+               conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except pg.Error as e:
+            logging.error("Dropping broken connection: %s", e)
+            conn.close()
+            return self.putconn(conn)
+
+        with self.cond:
+            self.idle.append(conn)
+            self.cond.notify_all()
+
+
+    def connect(self):
+        '''
+        Open a dedicated connection outside the pool, for workers that must
+        not share a connection with batched loads. The caller closes it.
+        '''
+
+        return pg.connect(**self.dsn)
+
+
+    def settle(self, keys):
+        '''
+        Pass the keys of loads that were just committed or rolled back to
+        on_settle.
+        '''
+
+        if keys and self.on_settle is not None:
+            self.on_settle(keys)
+
+
+    def has_pending(self, key):
+        '''
+        Whether a load touching key is waiting to be committed on any
+        connection.
+        '''
+
+        with self.cond:
+            return any(key in keys for keys in self.touched.values())
+
+
+    def loaded(self, conn, count=1, keys=()):
+        '''
+        Record count successful loads touching keys on conn and commit once
+        the transaction size has been reached.
+        '''
+
+        with self.cond:
+            n = self.pending.get(id(conn), 0) + count
+            self.pending[id(conn)] = n
+            self.touched.setdefault(id(conn), set()).update(keys)
+            if n < self.txnsize:
+                return
+            self.pending[id(conn)] = 0
+            keys = self.touched.pop(id(conn))
+
+        conn.commit()
+        self.settle(keys)
+
+
+    def rollback(self, conn):
+        '''
+        Abort the loads pending on conn.
+        '''
+
+        with self.cond:
+            pending = self.pending.pop(id(conn), 0)
+            keys = self.touched.pop(id(conn), None)
+        if pending:
+            conn.rollback()
+        self.settle(keys)
+
+
+    def discard_pending(self, conn):
+        '''
+        Forget the loads pending on conn after it has already been rolled back.
+        '''
+
+        with self.cond:
+            self.pending.pop(id(conn), None)
+            keys = self.touched.pop(id(conn), None)
+        self.settle(keys)
+
+
+    def commit_idle(self):
+        '''
+        Commit the pending loads on every connection not currently in use.
+        '''
+
+        keys = set()
+        with self.cond:
+            for conn in self.idle:
+                if self.pending.pop(id(conn), 0):
+                    conn.commit()
+                keys.update(self.touched.pop(id(conn), ()))
+        self.settle(keys)
+
+
+    def rollback_idle(self):
+        '''
+        Roll back the pending loads on every connection not currently in use.
+        '''
+
+        keys = set()
+        with self.cond:
+            for conn in self.idle:
+                self.pending.pop(id(conn), None)
+                keys.update(self.touched.pop(id(conn), ()))
+                conn.rollback()
+        self.settle(keys)
+
+
+    def closeall(self):
+        '''
+        Close every idle connection. Connections still checked out are closed
+        when they are returned.
+        '''
+
+        with self.cond:
+            for conn in self.idle:
+                conn.close()
+            self.size -= len(self.idle)
+            self.idle = []
+            self.pending = {}
+            self.touched = {}
+            self.closed = True
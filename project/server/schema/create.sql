@@ -14,7 +14,8 @@ CREATE TABLE ri_restaurants (
     zip char(5),
     location point,
     clean boolean DEFAULT FALSE,
-    PRIMARY KEY (id)
+    PRIMARY KEY (id),
+    CONSTRAINT ri_restaurants_name_address_key UNIQUE (name, address)
 );
 
 CREATE TABLE ri_inspections (
@@ -29,6 +30,25 @@ CREATE TABLE ri_inspections (
     FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants
 );
 
+CREATE INDEX ri_inspections_restaurant_id_idx ON ri_inspections (restaurant_id);
+
+-- per restaurant aggregates of ri_inspections, kept up to date as
+-- inspections are loaded and re-pointed by the linkage
+CREATE TABLE ri_restaurant_summary (
+    restaurant_id int,
+    inspection_count int NOT NULL DEFAULT 0,
+    latest_inspection_id varchar(16),
+    latest_inspection_date date,
+    latest_result varchar(50),
+    pass_count int NOT NULL DEFAULT 0,
+    fail_count int NOT NULL DEFAULT 0,
+    highest_risk varchar(50),
+    highest_risk_rank smallint NOT NULL DEFAULT 4,
+    violation_count int NOT NULL DEFAULT 0,
+    PRIMARY KEY (restaurant_id),
+    FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants
+);
+
 CREATE TABLE ri_tweetmatch (
     tkey varchar(50),
     restaurant_id int,
@@ -46,3 +66,12 @@ CREATE TABLE ri_linked (
     FOREIGN KEY (original_rest_id) REFERENCES ri_restaurants
 );
 
+
+CREATE TABLE ri_bulk_checkpoints (
+    load_id varchar(100),
+    rows_committed bigint NOT NULL DEFAULT 0,
+    rows_inserted bigint NOT NULL DEFAULT 0,
+    finished boolean NOT NULL DEFAULT FALSE,
+    updated timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (load_id)
+);
@@ -1,3 +1,5 @@
+DROP TABLE IF EXISTS ri_bulk_checkpoints;
+DROP TABLE IF EXISTS ri_restaurant_summary;
 DROP TABLE IF EXISTS ri_inspections;
 DROP TABLE IF EXISTS ri_tweetmatch;
 DROP TYPE IF EXISTS match_type;
@@ -1,18 +1,216 @@
 from bottle import Bottle, post, get, HTTPResponse, request, response
 import argparse
+import datetime
+import hashlib
 import os
 import sys
 import psycopg2 as pg
 import logging
+import signal
 import string
+import threading
+import time
+import uuid
 from db import DB
+import match_records
+from pool import ConnectionPool, PoolTimeout
+from cache import LRUCache
+from tweet_index import RestaurantIndex
+import streams
 import json
 
 logging.basicConfig(level=logging.INFO)
 app = Bottle()
+app.db_pool = None
+pool_lock = threading.Lock()
+
+# read-through cache for restaurant and inspection lookups, see cached(),
+# and serialized JSON responses for the same endpoints, see render()
+app.read_cache = LRUCache(10000, 300)
+app.response_cache = LRUCache(10000, 300)
+# cache keys of the views dropped when a restaurant's inspections load
+RESTAURANT_VIEWS = ('restaurant', 'restaurant-record', 'summary')
+app.compact_json = False
+app.link_workers = 1
+app.link_strategies = ('zip',)
+app.link_window = 5
+
+# candidate pair counts of the last large scale /clean, see /clean/report
+app.link_report = {}
+
+# restaurant names and locations, so tweets are matched in process and the
+# database is only touched to record matches, see local_matches()
+app.tweet_index = RestaurantIndex(250, 60)
+
+# progress of chunked bulk loads run by this process, keyed by load id
+bulk_progress = {}
+bulk_progress_lock = threading.Lock()
+# how long, and how many, ended chunked loads are reported from memory
+BULK_PROGRESS_RETENTION = 3600
+BULK_PROGRESS_LIMIT = 1000
+
+# keyword each bottle server adapter uses for its number of workers/threads
+WORKER_OPTIONS = {
+    'gunicorn': 'workers',
+    'waitress': 'threads',
+    'cheroot': 'numthreads',
+    'paste': 'threadpool_workers',
+}
+
+
+def get_pool():
+    """
+    Returns this process's connection pool, opening it on first use so that
+    pre-forked workers never share connections inherited from the parent.
+    """
+
+    if app.db_pool is None or app.db_pool.pid != os.getpid():
+        with pool_lock:
+            if app.db_pool is None or app.db_pool.pid != os.getpid():
+                app.db_pool = ConnectionPool(
+                    int(app.config.get('pool.minconn', 1)),
+                    int(app.config.get('pool.maxconn', 10)),
+                    float(app.config.get('pool.timeout', 30)),
+                    on_settle=invalidate_restaurants,
+                    **app.db_dsn
+                )
+
+    return app.db_pool
+
+
+def close_pool(server=None, worker=None):
+    """
+    Closes this process's connection pool, if it has one. Also used as the
+    gunicorn worker_exit hook.
+    """
+
+    if app.db_pool is not None and app.db_pool.pid == os.getpid():
+        app.db_pool.closeall()
+
+
+def get_db(clean=False, loads=False):
+    """
+    Returns a DB wrapping the connection checked out of the pool for the
+    current request; the first call of a request picks it. The connection
+    is returned by release_db. Handlers that commit or roll back on their
+    own pass clean=True so they never touch another client's batched loads,
+    and the /inspections handlers pass loads=True to keep batching on the
+    connection holding the open transaction. Answers 503 if the pool stays
+    exhausted.
+    """
+
+    conn = request.environ.get('db.connection')
+    if conn is None:
+        try:
+            conn = get_pool().getconn(clean, loads)
+        except PoolTimeout as e:
+            logging.error("%s", e)
+            raise HTTPResponse(status=503)
+        request.environ['db.connection'] = conn
+
+    return DB(conn)
+
+
+@app.hook('after_request')
+def release_db():
+    conn = request.environ.pop('db.connection', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+
+
+def cacheable(key):
+    """
+    Views of a restaurant with loads still waiting to be committed are not
+    cached: they are evicted once the loads commit or roll back, and a read
+    in between may see either state.
+    """
+
+    return key[0] not in RESTAURANT_VIEWS or not get_pool().has_pending(key[1])
+
+
+def cached(key, lookup):
+    """
+    Returns the result of a DB lookup through the read cache. lookup is only
+    called (and a connection only checked out) on a miss, and only results
+    with a 200 status are cached, see cacheable.
+    """
+
+    hit, result = app.read_cache.get(key)
+    if hit:
+        return result
+
+    result = lookup()
+    if result[0] == 200 and cacheable(key):
+        app.read_cache.put(key, result)
+
+    return result
+
+
+def render(key, build):
+    """
+    Serves a JSON response from the pre-serialized response cache. On a miss
+    build() returns (status, data), which is serialized once and, for a 200,
+    given an ETag and cached as bytes when there is a key. A request whose
+    If-None-Match matches the ETag of a 200 gets an empty 304. A None data
+    gives an empty body, as the handlers did for errors.
+    """
+
+    hit, entry = app.response_cache.get(key) if key else (False, None)
+    if not hit:
+        status, data = build()
+        body = None
+        etag = None
+        if data is not None:
+            if app.compact_json:
+                body = json.dumps(data, separators=(',', ':')).encode()
+            else:
+                body = json.dumps(data, sort_keys=False, indent=4).encode()
+            if status == 200:
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        entry = (status, etag, body)
+        if key and etag and cacheable(key):
+            app.response_cache.put(key, entry)
+
+    status, etag, body = entry
+    if etag:
+        if etag_matches(etag, request.headers.get('If-None-Match')):
+            return HTTPResponse(status=304, headers={'ETag': etag})
+        response.set_header('ETag', etag)
+    if body is not None:
+        response.content_type = 'application/json'
+    response.status = status
+
+    return body
+
+
+def etag_matches(etag, if_none_match):
+    """
+    Whether an If-None-Match header names etag, comparing whole tags weakly
+    (a W/ prefix is ignored) or matching any tag with *.
+    """
+
+    if not if_none_match:
+        return False
+
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag or tag == 'W/' + etag:
+            return True
 
-txnsize_global = 1
-load_count = 0
+    return False
+
+
+def clear_caches():
+    app.read_cache.clear()
+    app.response_cache.clear()
+    app.tweet_index.mark_dirty()
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {'read': app.read_cache.stats(),
+            'response': app.response_cache.stats(),
+            'tweets': app.tweet_index.stats()}
 
 
 @app.get("/hello")
@@ -23,21 +221,40 @@ def hello():
 @app.get("/restaurants/<restaurant_id:int>")
 def find_restaurant(restaurant_id):
     """
-    Returns a restaurant and all of its associated inspections.
+    Returns a restaurant and all of its associated inspections, newest first.
+    Pass limit=N to page through long histories and after=<inspection id>
+    (the 'next' value of the previous page) to continue.
     """
 
-    db = DB(app.db_connection)
+    try:
+        limit = int(request.query.limit) if request.query.limit else None
+    except ValueError:
+        limit = 0
+    if limit is not None and limit <= 0:
+        response.status = 400
+        return None
+    after = request.query.after or None
 
-    status, restaurant = db.find_restaurant(restaurant_id)
-    inspections = db.find_inspections(restaurant_id)[1]
-    response.status = status
+    def build():
+        # only the default, unpaged view is cached
+        if limit is None and after is None:
+            status, restaurant, inspections = cached(('restaurant', restaurant_id),
+                lambda: get_db().find_restaurant_with_inspections(restaurant_id))
+        else:
+            status, restaurant, inspections = get_db().find_restaurant_with_inspections(
+                restaurant_id, limit, after)
 
-    # format restaurant data into pretty JSON
-    data = json.dumps({'restaurant': restaurant,
-                       'inspections': inspections},
-                       sort_keys=False, indent=4)
+        body = {'restaurant': restaurant,
+                'inspections': inspections}
+        if limit is not None:
+            body['next'] = inspections[-1]['id'] if len(inspections) == limit else None
 
-    return data
+        return status, body
+
+    if limit is None and after is None:
+        return render(('restaurant', restaurant_id), build)
+
+    return render(None, build)
 
 
 @app.get("/restaurants/by-inspection/<inspection_id>")
@@ -46,61 +263,299 @@ def find_restaurant_by_inspection_id(inspection_id):
     Returns a restaurant associated with a given inspection.
     """
 
-    db = DB(app.db_connection)
+    def build():
+        # get the inspection record
+        status, inspection = cached(('inspection', inspection_id),
+            lambda: get_db().find_inspection(inspection_id))
+
+        # throw an error if the inspection doesn't exist
+        if status >= 400:
+            return status, None
+
+        # grab the restaurant identifier from the inspection record and find 
+        # get the associated restaurant record
+        restaurant_id = inspection['restaurant_id']
+        return cached(('restaurant-record', restaurant_id),
+            lambda: get_db().find_restaurant(restaurant_id))
+
+    return render(('by-inspection', inspection_id), build)
+
+
+@app.get("/restaurants/<restaurant_id:int>/summary")
+def find_restaurant_summary(restaurant_id):
+    """
+    Returns a restaurant with its inspection summary: inspection count,
+    latest inspection date and result, pass and fail counts, highest risk
+    and violation count.
+    """
+
+    def build():
+        status, summaries = get_db().find_summaries([restaurant_id])
+        if status >= 400:
+            return status, None
+        if restaurant_id not in summaries:
+            return 404, None
+
+        return status, summaries[restaurant_id]
 
-    # get the inspection record
-    status, inspection = db.find_inspection(inspection_id)
+    return render(('summary', restaurant_id), build)
 
-    # throw an error if the inspection doesn't exist
+
+@app.get("/summaries")
+def find_restaurant_summaries():
+    """
+    Returns the inspection summaries of many restaurants for list views, eg
+    /summaries?ids=1,2,3, in the order asked for, plus the ids that could
+    not be found.
+    """
+
+    try:
+        ids = [int(i) for i in request.query.ids.split(',') if i.strip()]
+    except ValueError:
+        response.status = 400
+        return None
+    if not ids or len(ids) > 1000:
+        response.status = 400
+        return None
+
+    db = get_db()
+    status, summaries = db.find_summaries(ids)
     response.status = status
     if status >= 400:
         return None
 
-    # grab the restaurant identifier from the inspection record and find 
-    # get the associated restaurant record
-    restaurant_id = inspection['restaurant_id']
-    status, restaurant = db.find_restaurant(restaurant_id)
+    body = {
+        'summaries': [summaries[i] for i in ids if i in summaries],
+        'missing': [i for i in ids if i not in summaries]
+    }
+
+    return json.dumps(body, sort_keys=False, indent=4)
+
+
+@app.post("/restaurants/lookup")
+def find_restaurants():
+    """
+    Returns many restaurants and their inspections in one request. Takes
+    {"ids": [restaurant ids]} and responds with the found restaurants in the
+    order asked for, plus the ids that could not be found.
+    """
 
-    # throw an error if the restaurant doesn't exist
+    data = request.json
+    try:
+        ids = [int(i) for i in data['ids']]
+    except (KeyError, TypeError, ValueError):
+        response.status = 400
+        return None
+
+    db = get_db()
+    status, restaurants = db.find_restaurants(ids)
     response.status = status
     if status >= 400:
         return None
 
-    # format the restaurant record and send back
-    data = json.dumps(restaurant, sort_keys=False, indent=4)
+    body = {
+        'restaurants': [restaurants[i] for i in ids if i in restaurants],
+        'missing': [i for i in ids if i not in restaurants]
+    }
 
-    return data
+    return json.dumps(body, sort_keys=False, indent=4)
 
 
-# type check zip, state, 
-@app.post("/inspections")
-def load_inspection():
+@app.post("/restaurants/by-inspection")
+def find_restaurants_by_inspection_ids():
     """
-    Loads a new inspection (and possibly a new restaurant) into the database.
+    Returns the restaurant of each of many inspections in one request. Takes
+    {"inspection_ids": [...]} and responds with a mapping of inspection id to
+    restaurant, plus the inspection ids that could not be found.
     """
 
-    global load_count
-    global txnsize_global
+    data = request.json
+    try:
+        ids = [str(i) for i in data['inspection_ids']]
+    except (KeyError, TypeError):
+        response.status = 400
+        return None
 
-    db = DB(app.db_connection)
+    db = get_db()
+    status, restaurants = db.find_restaurants_by_inspections(ids)
+    response.status = status
+    if status >= 400:
+        return None
 
-    # load the json data into a list of dictionaries 
-    # or a dict in the case of a single record
-    record = request.json
+    body = {
+        'restaurants': restaurants,
+        'missing': [i for i in ids if i not in restaurants]
+    }
 
-    # check validity of inputs for zipcode and state 
-    if record['zip'] and not record['zip'].isnumeric():
-        if load_count > 0:
-            app.db_connection.rollback()
+    return json.dumps(body, sort_keys=False, indent=4)
+
+
+@app.get("/export/<table>")
+def export_table(table):
+    """
+    Streams every row of restaurants, inspections, tweetmatch or linked as csv
+    (the default) or ndjson with format=ndjson. Optional filters: zip,
+    clean=true|false, and from/to dates for inspections.
+    """
+
+    fmt = request.query.format or 'csv'
+    if table not in ('restaurants', 'inspections', 'tweetmatch', 'linked') or \
+       fmt not in ('csv', 'ndjson'):
         response.status = 400
         return None
 
-    if record['state'] and not record['state'].isalpha():
-        if load_count > 0:
-            app.db_connection.rollback()
+    clean = request.query.clean.lower() if request.query.clean else None
+    if clean not in (None, 'true', 'false'):
+        response.status = 400
+        return None
+
+    try:
+        start = request.query.get('from') or None
+        end = request.query.to or None
+        for d in (start, end):
+            if d:
+                datetime.date.fromisoformat(d)
+    except ValueError:
+        response.status = 400
+        return None
+
+    filters = {
+        'zip': request.query.zip or None,
+        'start': start,
+        'end': end,
+        'clean': None if clean is None else clean == 'true'
+    }
+
+    # the body is produced after this handler returns, so the export uses
+    # its own connection rather than the request's
+    pool = get_pool()
+
+    def stream():
+        conn = pool.getconn()
+        try:
+            for chunk in DB(conn).export_table(table, fmt, **filters):
+                yield chunk
+        finally:
+            pool.putconn(conn)
+
+    response.content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+
+    return stream()
+
+
+def search_params():
+    """
+    Read the search filters, page size and page key from the query string.
+    Returns (None, None, None) if any of them are invalid.
+    """
+
+    q = request.query
+    filters = {
+        'name': q.name or None,
+        'zip': q.zip or None,
+        'state': q.state or None,
+        'facility_type': q.facility_type or None,
+        'risk': q.risk or None,
+        'results': q.results or None,
+        'start': q.get('from') or None,
+        'end': q.to or None
+    }
+
+    try:
+        for d in (filters['start'], filters['end']):
+            if d:
+                datetime.date.fromisoformat(d)
+        limit = int(q.limit) if q.limit else 50
+    except ValueError:
+        return None, None, None
+    if limit <= 0 or limit > 1000:
+        return None, None, None
+
+    return filters, limit, q.after or None
+
+
+@app.get("/search/restaurants")
+def search_restaurants():
+    """
+    Search restaurants with optional name (prefix), zip, state and
+    facility_type filters, and risk, results and from/to date filters kept
+    to restaurants with a matching inspection. Results come in pages of limit (default 50) ordered
+    by id; pass the returned 'next' as after to get the following page.
+    """
+
+    filters, limit, after = search_params()
+    if filters is None:
         response.status = 400
         return None
 
+    try:
+        after = int(after) if after else None
+    except ValueError:
+        response.status = 400
+        return None
+
+    db = get_db()
+    status, restaurants, next_after = db.search_restaurants(filters, limit, after)
+    response.status = status
+    if status >= 400:
+        return None
+
+    data = json.dumps({'restaurants': restaurants, 'next': next_after},
+                      sort_keys=False, indent=4)
+
+    return data
+
+
+@app.get("/search/inspections")
+def search_inspections():
+    """
+    Search inspections with optional risk, results and from/to date filters
+    and name (prefix), zip, state and facility_type filters on the
+    restaurant, eg /search/inspections?zip=60614&results=Fail&from=2020-06-01.
+    Results come newest first in pages of limit (default 50); pass the
+    returned 'next' as after to get the following page.
+    """
+
+    filters, limit, after = search_params()
+    if filters is None:
+        response.status = 400
+        return None
+
+    if after:
+        try:
+            date, inspection_id = after.split(',', 1)
+            datetime.date.fromisoformat(date)
+            after = (date, inspection_id)
+        except ValueError:
+            response.status = 400
+            return None
+
+    db = get_db()
+    status, matches, next_after = db.search_inspections(filters, limit, after)
+    response.status = status
+    if status >= 400:
+        return None
+
+    data = json.dumps({'inspections': matches,
+                       'next': ','.join(next_after) if next_after else None},
+                      sort_keys=False, indent=4)
+
+    return data
+
+
+def parse_inspection_record(record):
+    """
+    Splits a posted inspection record into an inspection dict and a
+    restaurant dict. Returns (None, None) if the zip or state are invalid.
+    """
+
+    # check validity of inputs for zipcode and state 
+    if record['zip'] and not record['zip'].isnumeric():
+        return None, None
+
+    if record['state'] and not record['state'].isalpha():
+        return None, None
+
     # if given a clean status use it, otherwise set to None
     try:
         clean = record['clean']
@@ -108,7 +563,6 @@ def load_inspection():
         clean = False
 
     # parse inspection data from restaurant data
-    # load each inspection into the database
     inspection = {
             'id' : record['inspection_id'],
             'risk' : record['risk'],
@@ -128,41 +582,106 @@ def load_inspection():
             'clean' : clean
     }
 
+    return inspection, restaurant
+
+
+# type check zip, state, 
+@app.post("/inspections")
+def load_inspection():
+    """
+    Loads a new inspection (and possibly a new restaurant) into the database.
+    """
+
+    db = get_db(loads=True)
+
+    # load the json data into a dict for the single record
+    record = request.json
+
+    inspection, restaurant = parse_inspection_record(record)
+    if inspection is None:
+        get_pool().rollback(db.conn)
+        response.status = 400
+        return None
+
     # set response status and send back dictionary with restaurant id
     # respond with url for restaurant in header
     status, rest_id = db.add_inspection_for_restaurant(inspection, restaurant)
     response.status = status
 
     if status >= 400:
-        load_count = 0
+        if db.rolled_back:
+            get_pool().discard_pending(db.conn)
         return None
     else:
-        load_count += 1
-        if load_count >= txnsize_global:
-            app.db_connection.commit()
-            load_count = 0
-        
+        get_pool().loaded(db.conn, keys=(rest_id,))
+        index_restaurant(rest_id, restaurant)
+
     url_path_rest = 'http://localhost:30235/restaurants/'
     response.add_header('Location', url_path_rest + str(rest_id))
 
     return {'restaurant_id' : rest_id}
 
 
+@app.post("/inspections/batch")
+def load_inspections_batch():
+    """
+    Loads a JSON array of inspections (and possibly new restaurants) using a
+    handful of set-based statements. Responds with a status and restaurant id
+    for every record, in the order they were posted; a record the database
+    rejects gets its own 400 rather than failing the batch.
+    """
+
+    db = get_db(loads=True)
+
+    records = request.json
+    if not isinstance(records, list):
+        response.status = 400
+        return None
+
+    # invalid records get a 400 and are left out of the batch
+    results = [{'status': 400, 'restaurant_id': None} for _ in records]
+    positions = []
+    batch = []
+    for pos, record in enumerate(records):
+        try:
+            inspection, restaurant = parse_inspection_record(record)
+        except (KeyError, TypeError, AttributeError):
+            continue
+        if inspection is not None:
+            positions.append(pos)
+            batch.append((inspection, restaurant))
+
+    status, batch_results = db.add_inspections_for_restaurants(batch)
+    response.status = status
+
+    if status >= 400:
+        if db.rolled_back:
+            get_pool().discard_pending(db.conn)
+        return None
+
+    loaded = []
+    for pos, (_, restaurant), (rec_status, rest_id) in zip(positions, batch, batch_results):
+        results[pos] = {'status': rec_status, 'restaurant_id': rest_id}
+        if rec_status < 400:
+            loaded.append(rest_id)
+            index_restaurant(rest_id, restaurant)
+
+    if loaded:
+        get_pool().loaded(db.conn, len(loaded), loaded)
+
+    return {'results': results}
+
+
 @app.get("/txn/<txnsize:int>")
 def set_transaction_size(txnsize):
     '''
     This endpoint allows you to specify the number (transaction size) of post inspection
     requeststhat should be batched together for a transaction commit. 
+    Batches are counted per pooled connection.
     '''
 
-    global load_count
-    global txnsize_global
-
-    if load_count > 0:
-        app.db_connection.commit()
-        load_count = 0
-
-    txnsize_global = txnsize
+    get_pool().commit_idle()
+    get_pool().txnsize = txnsize
     response.status = 200
 
     return None
@@ -174,16 +693,129 @@ def abort_txn():
     This endpoint aborts/rollback any active transaction.
     '''
 
-    global load_count
-
     logging.info("Aborting active transactions")
-    app.db_connection.rollback()
-    load_count = 0
+    get_pool().rollback_idle()
+    clear_caches()
     response.status = 200
 
     return None
  
 
+def index_restaurant(restaurant_id, restaurant):
+    '''
+    Add a restaurant that was just loaded to the tweet index.
+    '''
+
+    app.tweet_index.add(restaurant_id, restaurant['name'], restaurant['location'])
+
+
+def invalidate_restaurants(restaurant_ids):
+    '''
+    Drop the cached views of restaurants once the transaction holding loads
+    of their inspections commits or rolls back. Called by the pool.
+    '''
+
+    for restaurant_id in restaurant_ids:
+        for view in RESTAURANT_VIEWS:
+            app.read_cache.invalidate((view, restaurant_id))
+            app.response_cache.invalidate((view, restaurant_id))
+
+
+def run_bulk_load(db, data, default_load_id):
+    '''
+    Hand a bulk csv to the DB. When the request has a chunk=N query parameter
+    the load commits every N rows and can be resumed by repeating the request
+    with the same load_id; its progress is reported by /bulkstatus. With a
+    parallel=N query parameter the pieces are instead copied concurrently
+    over N pooled connections (chunk then sets the piece size).
+    '''
+
+    if request.query.get('parallel'):
+        try:
+            workers = int(request.query.get('parallel'))
+            chunk_size = int(request.query.get('chunk') or 50000)
+        except ValueError:
+            workers = chunk_size = 0
+        if workers <= 0 or chunk_size <= 0:
+            response.status = 400
+            return None
+
+        # the COPY workers open their own connections, as many as the pool
+        # may hold at most
+        pool = get_pool()
+        workers = min(workers, pool.maxconn)
+        response.status = db.parallel_bulk_loading(pool, data, workers, chunk_size)
+        clear_caches()
+        return None
+
+    if not request.query.get('chunk'):
+        response.status = db.bulk_loading(data)
+        clear_caches()
+        return None
+
+    try:
+        chunk_size = int(request.query.get('chunk'))
+    except ValueError:
+        chunk_size = 0
+    if chunk_size <= 0:
+        response.status = 400
+        return None
+
+    load_id = request.query.get('load_id') or default_load_id
+    progress = {
+        'load_id': load_id,
+        'state': 'running',
+        'rows_skipped': 0,
+        'rows_copied': 0,
+        'rows_inserted': 0,
+        'started': time.time(),
+        'ended': None
+    }
+    with bulk_progress_lock:
+        prune_bulk_progress()
+        bulk_progress[load_id] = progress
+
+    response.status = db.bulk_loading_chunked(data, load_id, chunk_size, progress)
+    progress['ended'] = time.time()
+
+    clear_caches()
+
+    return progress_report(progress)
+
+
+def prune_bulk_progress():
+    '''
+    Forget chunked loads that ended more than BULK_PROGRESS_RETENTION seconds
+    ago, then the oldest ended loads beyond BULK_PROGRESS_LIMIT entries. Their
+    status is still reported from the checkpoint. Call with
+    bulk_progress_lock held.
+    '''
+
+    cutoff = time.time() - BULK_PROGRESS_RETENTION
+    ended = sorted((p['ended'], load_id) for load_id, p in bulk_progress.items()
+                   if p['ended'] is not None)
+    excess = len(bulk_progress) - BULK_PROGRESS_LIMIT
+    for k, (end, load_id) in enumerate(ended):
+        if end < cutoff or k < excess:
+            del bulk_progress[load_id]
+
+
+def progress_report(progress):
+    '''
+    Format the progress of a chunked bulk load for a response.
+    '''
+
+    end = progress['ended'] or time.time()
+    return {
+        'load_id': progress['load_id'],
+        'state': progress['state'],
+        'rows_skipped': progress['rows_skipped'],
+        'rows_copied': progress['rows_copied'],
+        'rows_inserted': progress['rows_inserted'],
+        'elapsed': end - progress['started']
+    }
+
+
 @app.get("/bulkload/<file_name:path>")
 def bulk_load(file_name):
     '''
@@ -195,11 +827,11 @@ def bulk_load(file_name):
     base_dir = "../data"
     file_path = os.path.join(base_dir,file_name)
 
-    db = DB(app.db_connection)
+    db = get_db(clean=True)
 
     try:
         with open(file_path, 'r') as data:
-            response.status = db.bulk_loading(data)
+            return run_bulk_load(db, data, file_name)
     except FileNotFoundError:
         response.status = 404
         return None
@@ -208,7 +840,56 @@ def bulk_load(file_name):
         response.status = 400
         return None
 
-    return None
+
+@app.post("/bulkload")
+def bulk_load_stream():
+    '''
+    Stream inspection records in the request body straight into the bulk
+    loader's COPY. The body is a csv with a header row, or newline delimited
+    JSON when sent as application/x-ndjson, and may be sent with
+    Content-Encoding: gzip.
+    '''
+
+    db = get_db(clean=True)
+
+    try:
+        data = streams.request_stream(request.environ)
+    except ValueError:
+        response.status = 400
+        return None
+
+    return run_bulk_load(db, data, uuid.uuid4().hex)
+
+
+@app.get("/bulkstatus/<load_id>")
+def bulk_load_status(load_id):
+    '''
+    Report rows copied, rows inserted and elapsed seconds for a chunked bulk
+    load. Loads not run by this process, or ended long ago, are reported from
+    their checkpoint, without an elapsed time.
+    '''
+
+    with bulk_progress_lock:
+        progress = bulk_progress.get(load_id)
+    if progress:
+        return progress_report(progress)
+
+    db = get_db()
+    status, checkpoint = db.get_bulk_checkpoint(load_id)
+    response.status = status
+    if not checkpoint:
+        return None
+
+    # same fields as progress_report; a load that is not running here and
+    # not finished was interrupted or runs in another process
+    return {
+        'load_id': checkpoint['load_id'],
+        'state': 'finished' if checkpoint['finished'] else 'stopped',
+        'rows_skipped': 0,
+        'rows_copied': checkpoint['rows_committed'],
+        'rows_inserted': checkpoint['rows_inserted'],
+        'elapsed': None
+    }
 
 
 @app.get("/reset")
@@ -221,8 +902,10 @@ def reset_db():
     abort_txn()
 
     logging.info("Reseting DB")
-    db = DB(app.db_connection)
+    db = get_db(clean=True)
     status = db.reset_db()
+    clear_caches()
+    app.tweet_index.clear()
 
     response.status = status
 
@@ -238,7 +921,7 @@ def count_insp():
     '''
 
     logging.info("Counting Inspections")
-    db = DB(app.db_connection)
+    db = get_db()
 
     status, N = db.count_all_insp()
     response.status = status
@@ -256,6 +939,69 @@ def ngrams(tweet, n):
     return output
 
 
+def parse_tweet(data):
+    '''
+    Extract the key, the 1 to 4 word ngrams of the text and the location of a
+    posted tweet. Raises KeyError if a field is missing.
+    '''
+
+    if data['lat'] and data['long']:
+        lat = float(data['lat'])
+        lon = float(data['long'])
+    else:
+        lat = None
+        lon = None
+
+    text = data['text'].upper()
+    ngram = []
+    for n in range(1,5):
+        ngram += ngrams(text, n)
+
+    return {
+        'tkey': str(data['key']),
+        'ngram': ngram,
+        'long': lon,
+        'lat': lat
+        }
+
+
+def tweet_index_ready():
+    '''
+    Refresh the tweet index if it is due. Returns False while it has never
+    loaded, in which case tweets are matched in the database.
+    '''
+
+    # clean, as the tweet handlers go on to commit on the same connection
+    if app.tweet_index.needs_refresh():
+        app.tweet_index.refresh(get_db(clean=True))
+
+    return app.tweet_index.ready()
+
+
+def local_matches(tweet_data):
+    '''
+    Match a parsed tweet against the names and locations in the tweet index. Returns the
+    (tkey, restaurant_id, match) rows to record in ri_tweetmatch.
+    '''
+
+    names = app.tweet_index.ids(tweet_data['ngram'])
+    near = set()
+    if tweet_data['lat'] and tweet_data['long']:
+        near = app.tweet_index.near(tweet_data['long'], tweet_data['lat'])
+
+    rows = []
+    for restaurant_id in sorted(names | near):
+        if restaurant_id not in near:
+            match = 'name'
+        elif restaurant_id not in names:
+            match = 'geo'
+        else:
+            match = 'both'
+        rows.append((tweet_data['tkey'], restaurant_id, match))
+
+    return rows
+
+
 @app.post("/tweet")
 def tweet():
     '''
@@ -268,32 +1014,23 @@ def tweet():
     data = request.json
 
     try:
-        if data['lat'] and data['long']:
-            lat = float(data['lat'])
-            lon = float(data['long'])
-        else:
-            lat = None
-            lon = None
-
-        text = data['text'].upper()
-        ngram = []
-        for n in range(1,5):
-            ngram += ngrams(text, n)
-
-        tweet_data = {
-            'tkey': data['key'],
-            'ngram': ngram,
-            'long': lon,
-            'lat': lat
-            }
-
+        tweet_data = parse_tweet(data)
     except KeyError:
         response.status = 400
         logging.error('Error parsing JSON from client')
         return None
 
-    db = DB(app.db_connection)
-    status, restaurant_ids = db.match_tweet(tweet_data)
+    # most tweets match nothing; once the index has loaded those are
+    # answered without a query
+    if tweet_index_ready():
+        rows = local_matches(tweet_data)
+        if not rows:
+            return json.dumps({'match': []}, sort_keys=False, indent=4)
+        status, matched = get_db(clean=True).insert_tweet_matches(rows)
+        restaurant_ids = matched.get(tweet_data['tkey'], [])
+    else:
+        status, restaurant_ids = get_db(clean=True).match_tweet(tweet_data,
+                                                                app.tweet_index.radius)
     response.status = status
 
     if status >= 400:
@@ -305,11 +1042,63 @@ def tweet():
     return data
 
 
+@app.post("/tweets/batch")
+def tweets_batch():
+    '''
+    Receive a JSON array of tweets and match them all against the tweet
+    index (or, while it is loading, with a single set-based statement),
+    recording the matches in ri_tweetmatch in one pass. Responds with the matched restaurant ids of every tweet,
+    in the order they were posted; unparseable tweets get a 400 status.
+    '''
+
+    data = request.json
+    if not isinstance(data, list):
+        response.status = 400
+        return None
+
+    ready = tweet_index_ready()
+    results = []
+    batch = []
+    for record in data:
+        try:
+            tweet_data = parse_tweet(record)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            results.append({'key': None, 'status': 400, 'match': []})
+            continue
+        results.append({'key': tweet_data['tkey'], 'status': 200, 'match': []})
+        if ready:
+            batch.extend(local_matches(tweet_data))
+        else:
+            batch.append(tweet_data)
+
+    # a batch the index found nothing in is answered without a query
+    matched = {}
+    if batch:
+        db = get_db(clean=True)
+        if ready:
+            status, matched = db.insert_tweet_matches(batch)
+        else:
+            status, matched = db.match_tweets(batch, app.tweet_index.radius)
+        response.status = status
+
+        if status >= 400:
+            logging.error('Error inserting/matching tweet batch')
+            return None
+
+    for result in results:
+        if result['key'] in matched:
+            result['match'] = matched[result['key']]
+
+    data = json.dumps({'results': results}, sort_keys=False, indent=4)
+
+    return data
+
+
 @app.get("/buildidx")
 def build_indexes():
     logging.info("Building indexes")
     
-    db = DB(app.db_connection)
+    db = get_db(clean=True)
     status = db.add_restaurants_index()
 
     response.status = status
@@ -321,7 +1110,7 @@ def build_indexes():
 def find_tweet_keys_by_inspection_id(inspection_id):
     logging.info("Finding tweet keys by inspection ID")
 
-    db = DB(app.db_connection)
+    db = get_db()
     status, tkeys = db.get_tweets_by_insp(inspection_id)
 
     response.status = status
@@ -334,29 +1123,40 @@ def find_tweet_keys_by_inspection_id(inspection_id):
 def clean_restaurants():
     logging.info("Cleaning Restaurants")
     
-    db = DB(app.db_connection)
+    db = get_db(clean=True)
 
     if app.scaling:
-        status = db.find_and_update_linked_restaurants_fast()
+        status = db.find_and_update_linked_restaurants_fast(
+            app.link_workers, app.link_strategies, app.link_window, app.link_report)
     else:
         status = db.find_and_update_linked_restaurants()
+    clear_caches()
 
     response.status = status
 
     return None
 
     
+@app.get("/clean/report")
+def clean_report():
+    '''
+    Report how many candidate pairs each blocking strategy proposed in the
+    last large scale /clean run by this process, against the number of
+    pairs compared and matched, to help tune [linkage] in server.conf.
+    '''
+
+    return {'strategies': list(app.link_strategies),
+            'window': app.link_window,
+            'last_run': app.link_report}
+
+
 @app.get("/restaurants/all-by-inspection/<inspection_id>")
 def find_all_restaurants_by_inspection_id(inspection_id):
     logging.info("Get All Restaurants")
     
-    db = DB(app.db_connection)
-    status, restaurants = db.find_all_restaurants(inspection_id)
-
-    response.status = status
-    data = json.dumps(restaurants, sort_keys=False, indent=4)
-
-    return data
+    return render(('all-by-inspection', inspection_id),
+        lambda: cached(('all-by-inspection', inspection_id),
+            lambda: get_db().find_all_restaurants(inspection_id)))
  
 
 if __name__ == "__main__":
@@ -378,12 +1178,38 @@ if __name__ == "__main__":
         type=int
     )
 
+    parser.add_argument(
+        "--server",
+        help="WSGI server to run under (default wsgiref, single threaded)",
+        choices=['wsgiref', 'cheroot', 'waitress', 'paste', 'gunicorn'],
+        default="wsgiref"
+    )
+    parser.add_argument(
+        "-w","--workers",
+        help="Threads for cheroot/waitress/paste, or pre-forked processes for gunicorn (default 1)",
+        default=1,
+        type=int
+    )
+
+    parser.add_argument(
+        "--compact-json",
+        help="Serve compact rather than indented JSON from the read endpoints",
+        default=False,
+        action="store_true"
+    )
+
     parser.add_argument(
         "-s","--scaling",
         help="Enable large scale cleaning",
         default=False,
         action="store_true"
     )
+    parser.add_argument(
+        "--link-workers",
+        help="Processes linking (state, zip) blocks in parallel during large scale cleaning (default 1)",
+        default=1,
+        type=int
+    )
 
 
     args = parser.parse_args()
@@ -392,26 +1218,56 @@ if __name__ == "__main__":
         sys.exit(1)
 
     app.config.load_config(args.config)
+    app.read_cache = LRUCache(int(app.config.get('cache.size', 10000)),
+                              float(app.config.get('cache.ttl', 300)))
+    app.response_cache = LRUCache(int(app.config.get('cache.responses', 10000)),
+                                  float(app.config.get('cache.ttl', 300)))
+    app.compact_json = args.compact_json
+    index_ttl = float(app.config.get('tweets.index_ttl', 60))
+    app.tweet_index = RestaurantIndex(float(app.config.get('tweets.radius', 250)),
+                                      index_ttl)
     app.scaling=False
+    app.link_workers = max(1, args.link_workers)
+    app.link_strategies = tuple(s.strip() for s in
+        app.config.get('linkage.strategies', 'zip').split(',') if s.strip())
+    app.link_window = int(app.config.get('linkage.window', 5))
+    unknown = set(app.link_strategies) - set(match_records.BLOCKING_STRATEGIES)
+    # 'zip' already compares every pair, other passes would add nothing
+    mixed = 'zip' in app.link_strategies and len(app.link_strategies) > 1
+    if not app.link_strategies or unknown or mixed or app.link_window < 2:
+        logging.error("Invalid [linkage] options in {}".format(args.config))
+        sys.exit(1)
     try:
-        app.db_connection = pg.connect(
-            dbname = app.config['db.dbname'],
-            user = app.config['db.user'],
-            password = app.config.get('db.password'),
-            host = app.config['db.host'],
-            port = app.config['db.port']
-        )
+        app.db_dsn = {
+            'dbname': app.config['db.dbname'],
+            'user': app.config['db.user'],
+            'password': app.config.get('db.password'),
+            'host': app.config['db.host'],
+            'port': app.config['db.port']
+        }
     except KeyError as e:
         logging.error("Is your configuration file ({})".format(args.config) +
                       " missing options?")
         raise
 
+    options = {}
+    if args.server in WORKER_OPTIONS:
+        options[WORKER_OPTIONS[args.server]] = args.workers
+    elif args.workers > 1:
+        logging.warning("The %s server is single threaded, ignoring --workers" % (args.server))
+
+    if args.server == 'gunicorn':
+        # workers open their own pools after the fork
+        options['worker_exit'] = close_pool
+    else:
+        get_pool()
+        # let SIGTERM stop the server the same way Ctrl-C does
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     try:
         if args.scaling:
             app.scaling = True
-        logging.info("Starting Inspection Service. App Scaling= %s" % (app.scaling))
-        app.run(host=args.host, port=args.port)
+        logging.info("Starting Inspection Service. App Scaling= %s, Server= %s, Workers= %s" % (app.scaling, args.server, args.workers))
+        app.run(host=args.host, port=args.port, server=args.server, **options)
     finally:
-        app.db_connection.close()
-
+        close_pool()
@@ -0,0 +1,142 @@
+'''
+Provides file-like wrappers used to stream a request body straight into the
+bulk loader's COPY without buffering the whole upload in memory.
+'''
+
+import codecs
+import csv
+import gzip
+import io
+import json
+
+# column order of the bulk_temp table in db.py
+BULK_COLUMNS = ['inspection_id', 'name', 'aka_name', 'facility_type', 'risk',
+                'address', 'city', 'state', 'zip', 'date', 'inspection_type',
+                'results', 'violations', 'latitude', 'longitude', 'location']
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson',
+                'application/jsonl', 'application/x-jsonlines')
+
+
+class BodyReader(io.RawIOBase):
+    '''
+    Reads at most length bytes from a WSGI input stream. A length of None
+    reads until the server signals the end of a chunked body.
+    '''
+
+    def __init__(self, wsgi_input, length):
+        self.wsgi_input = wsgi_input
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = len(b)
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        if size <= 0:
+            return 0
+
+        data = self.wsgi_input.read(size)
+        b[:len(data)] = data
+        if self.remaining is not None:
+            self.remaining -= len(data)
+
+        return len(data)
+
+
+class NDJSONReader:
+    '''
+    Converts newline delimited JSON inspection records into CSV with a header
+    row, in the column order COPY expects, as it is read.
+    '''
+
+    def __init__(self, fileobj):
+        self.lines = io.TextIOWrapper(fileobj, encoding='utf-8')
+        self.buf = io.StringIO()
+        self.writer = csv.writer(self.buf, lineterminator='\n')
+        self.writer.writerow(BULK_COLUMNS)
+        self.pending = self.take()
+        self.done = False
+
+    def take(self):
+        data = self.buf.getvalue()
+        self.buf.seek(0)
+        self.buf.truncate()
+        return data
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.pending) < size):
+            line = self.lines.readline()
+            if not line:
+                self.done = True
+                break
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            self.writer.writerow([record.get(c) for c in BULK_COLUMNS])
+            self.pending += self.take()
+
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+
+        return data
+
+
+def text_lines(fileobj, size=65536):
+    '''
+    Iterate over the lines of a file-like object that only needs a read
+    method, decoding bytes as utf-8. Used to feed csv.reader from any of the
+    readers above as well as from plain files.
+    '''
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    while True:
+        raw = fileobj.read(size)
+        if not raw:
+            break
+        block = decoder.decode(raw) if isinstance(raw, bytes) else raw
+        lines = (pending + block).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    # bytes of a character cut off by the end of the input raise here
+    pending += decoder.decode(b'', final=True)
+    lines = pending.split('\n')
+    pending = lines.pop()
+    for line in lines:
+        yield line + '\n'
+
+    if pending:
+        yield pending
+
+
+def request_stream(environ):
+    '''
+    Wrap the body of a WSGI request as a file-like object of CSV for COPY.
+    The body may be CSV with a header row, or newline delimited JSON when
+    sent with an NDJSON content type, and may be gzip compressed.
+    '''
+
+    length = environ.get('CONTENT_LENGTH')
+    if length:
+        length = int(length)
+    elif 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+        length = None
+    else:
+        length = 0
+
+    body = io.BufferedReader(BodyReader(environ['wsgi.input'], length))
+
+    if environ.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+        body = gzip.GzipFile(fileobj=body, mode='rb')
+
+    content_type = environ.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+    if content_type in NDJSON_TYPES:
+        return NDJSONReader(body)
+
+    return body
@@ -0,0 +1,202 @@
+'''
+Provides an in-process index of restaurant names and locations used by the
+tweet endpoints in server.py to find the restaurants a tweet matches without
+searching ri_restaurants.
+'''
+
+import logging
+import math
+import threading
+import time
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def parse_point(location):
+    '''
+    Returns (lon, lat) from point text such as "(-87.6, 41.9)", or None.
+    '''
+
+    try:
+        lon, lat = str(location).strip().strip('()').split(',')
+        return float(lon), float(lat)
+    except (AttributeError, ValueError):
+        return None
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    '''
+    Great-circle distance in meters between two points given in degrees.
+    '''
+
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+
+class RestaurantIndex:
+    '''
+    An in-process copy of the names and locations in ri_restaurants, kept in
+    sync incrementally. Names map UPPER(name) to the ids of the restaurants
+    with that name. Locations are kept in a grid answering "which restaurants
+    are within radius meters of this point": cells are radius meters of
+    latitude on a side, so a query scans the few cells around the point and
+    keeps the restaurants whose haversine distance is within the radius.
+
+    Restaurants inserted through this process are added as they load.
+    Restaurants inserted elsewhere (bulk loads, cleaning, other workers) are
+    picked up by refresh, which reads the rows above the highest id seen
+    when the index is marked dirty, and rereads every row once ttl seconds
+    have passed since the last full load. Both lookups are built from the
+    same read.
+    '''
+
+    def __init__(self, radius, ttl):
+        self.radius = radius
+        self.cell = radius / METERS_PER_DEGREE
+        self.ttl = ttl
+        self.names = {}
+        self.cells = {}
+        self.high_water = 0
+        self.loaded = None
+        self.dirty = True
+        self.lock = threading.Lock()
+
+
+    def index(self, names, cells, r):
+        '''
+        Add one restaurant row (id, upper-cased name, location) to names and
+        cells.
+        '''
+
+        names.setdefault(r['name'], set()).add(r['id'])
+
+        point = parse_point(r['location']) if r['location'] else None
+        if point is None:
+            return
+
+        lon, lat = point
+        key = (math.floor(lon / self.cell), math.floor(lat / self.cell))
+        cells.setdefault(key, {})[r['id']] = point
+
+
+    def ready(self):
+        return self.loaded is not None
+
+
+    def needs_refresh(self):
+        return self.dirty or self.loaded is None or \
+            time.monotonic() - self.loaded >= self.ttl
+
+
+    def mark_dirty(self):
+        '''
+        Pick up newly inserted restaurants on the next refresh.
+        '''
+
+        self.dirty = True
+
+
+    def clear(self):
+        '''
+        Reload every restaurant on the next refresh, eg after the tables were
+        reset.
+        '''
+
+        self.names = {}
+        self.cells = {}
+        self.loaded = None
+        self.dirty = True
+
+
+    def refresh(self, db):
+        '''
+        Bring the index up to date from db. Only one thread refreshes at a
+        time; the others keep reading the current entries meanwhile, while
+        add waits for the refresh to finish. Returns the status of the read.
+        '''
+
+        if not self.lock.acquire(blocking=False):
+            return 200
+
+        try:
+            full = self.loaded is None or time.monotonic() - self.loaded >= self.ttl
+            started = time.monotonic()
+            self.dirty = False
+
+            status, rows = db.find_restaurant_keys(0 if full else self.high_water)
+            if status >= 400:
+                self.dirty = True
+                logging.error("Could not refresh the restaurant index")
+                return status
+
+            names, cells = ({}, {}) if full else (self.names, self.cells)
+            high_water = 0 if full else self.high_water
+            for r in rows:
+                self.index(names, cells, r)
+                high_water = max(high_water, r['id'])
+
+            if full:
+                self.names = names
+                self.cells = cells
+                self.loaded = started
+            self.high_water = high_water
+        finally:
+            self.lock.release()
+
+        return status
+
+
+    def add(self, restaurant_id, name, location):
+        with self.lock:
+            self.index(self.names, self.cells, {'id': restaurant_id,
+                                                'name': name.upper(),
+                                                'location': location})
+
+
+    def ids(self, ngrams):
+        '''
+        Returns the ids of the restaurants named by any of the ngrams.
+        '''
+
+        names = self.names
+        found = set()
+        for g in set(ngrams):
+            found.update(names.get(g, ()))
+
+        return found
+
+
+    def near(self, lon, lat):
+        '''
+        Returns the ids of the restaurants within radius meters of lon, lat.
+        '''
+
+        cells = self.cells
+        dlat = self.radius / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+
+        found = set()
+        for x in range(math.floor((lon - dlon) / self.cell),
+                       math.floor((lon + dlon) / self.cell) + 1):
+            for y in range(math.floor((lat - dlat) / self.cell),
+                           math.floor((lat + dlat) / self.cell) + 1):
+                for restaurant_id, (plon, plat) in list(cells.get((x, y), {}).items()):
+                    if haversine(lon, lat, plon, plat) <= self.radius:
+                        found.add(restaurant_id)
+
+        return found
+
+
+    def stats(self):
+        return {
+            'names': len(self.names),
+            'cells': len(self.cells),
+            'high_water': self.high_water,
+            'ready': self.ready(),
+            'radius': self.radius,
+            'ttl': self.ttl
+        }